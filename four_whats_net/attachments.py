@@ -0,0 +1,220 @@
+"""PDF attachments for 4Whats.net `sendFile` payloads.
+
+The PDF is looked up once per dispatch with a single-row query and the
+resulting media descriptor is shared by every recipient's payload.
+
+A notification that names a WhatsApp print format gets its PDF rendered
+with it instead. Rendering is the most expensive step of a send, so each
+(document, print format, document version) is rendered once into an
+on-disk cache under the site's private files, evicted least recently used
+first past a size cap; a sender that finds the same PDF being rendered
+elsewhere waits for it instead of rendering it again.
+
+Rendered PDFs are never public: the provider (or a digest's reader) gets a
+signed link to `download_rendered_pdf` that expires after
+RENDERED_LINK_TTL, and no file is evicted while a link to it may still be
+valid.
+"""
+
+import hashlib
+import hmac
+import os
+import time
+from urllib.parse import urlencode
+
+import frappe
+from frappe import _
+from frappe.utils import cint, cstr, get_url
+from frappe.utils.password import get_encryption_key
+
+from four_whats_net.settings import get_settings
+from four_whats_net.utils import single_flight
+
+FOUR_WHATS_SETTINGS = "Four Whats Net Configuration"
+
+MEDIA_CACHE_KEY = "four_whats_net:whatsapp_media"
+MEDIA_CACHE_TTL = 24 * 60 * 60
+
+# Rendered PDFs live in <site>/private/files/PDF_CACHE_DIR, under names only we can derive
+PDF_CACHE_DIR = "whatsapp_pdf"
+DEFAULT_PDF_CACHE_SIZE_MB = 512
+RENDER_LOCK_KEY = "four_whats_net:pdf_render"
+RENDER_LOCK_TTL = 120
+
+# Seconds a link to a rendered PDF works; a file used more recently than this is never evicted
+RENDERED_LINK_TTL = 60 * 60
+
+
+def get_whatsapp_media(doctype, name, print_format=None):
+    """Return the `file` descriptor for a document's PDF, or None.
+
+    That is the PDF rendered with `print_format` if one is given, else the
+    newest PDF attached to the document.
+    """
+    # Per request / job memo so every recipient of one dispatch shares the lookup
+    if getattr(frappe.local, "whatsapp_media", None) is None:
+        frappe.local.whatsapp_media = {}
+    memo = frappe.local.whatsapp_media
+    key = (doctype, name, print_format)
+    if key not in memo:
+        memo[key] = resolve_media(doctype, name, print_format)
+    return memo[key]
+
+
+def get_notification_media(notification, doctype, name):
+    """The PDF a notification's WhatsApp message carries for a document."""
+    if not notification:
+        return get_whatsapp_media(doctype, name)
+    print_format = frappe.get_cached_value("Notification", notification, "whatsapp_print_format")
+    return get_whatsapp_media(doctype, name, print_format or None)
+
+
+def clear_media_memo():
+    frappe.local.whatsapp_media = None
+
+
+def resolve_media(doctype, name, print_format=None):
+    if print_format:
+        return get_rendered_media(doctype, name, print_format)
+
+    files = frappe.get_all(
+        "File",
+        filters={"attached_to_doctype": doctype, "attached_to_name": name, "file_type": "PDF"},
+        fields=["name", "file_url", "file_name", "modified"],
+        order_by="creation desc",
+        limit=1,
+    )
+    if not files:
+        return None
+
+    pdf_file = files[0]
+    key = f"{MEDIA_CACHE_KEY}:{doctype}:{name}:{pdf_file.modified}"
+    media = frappe.cache().get_value(key)
+    if media is None:
+        media = build_media(pdf_file)
+        frappe.cache().set_value(key, media, expires_in_sec=MEDIA_CACHE_TTL)
+    return media
+
+
+def build_media(pdf_file):
+    return {
+        "mimetype": "application/pdf",
+        "filename": pdf_file.file_name,
+        # Absolute URL from the site's own host name, so the provider can fetch it
+        "url": get_url(pdf_file.file_url),
+    }
+
+
+def get_rendered_media(doctype, name, print_format):
+    """Descriptor for the document rendered with `print_format`, rendering it only if no one has."""
+    modified = frappe.db.get_value(doctype, name, "modified")
+    token = get_render_token(doctype, name, print_format, modified)
+    path = get_rendered_path(token)
+    try:
+        try:
+            # Recently used: the eviction keeps it for as long as the link we hand out works
+            os.utime(path)
+        except FileNotFoundError:
+            render_once(doctype, name, print_format, token, path)
+    except Exception:
+        frappe.log_error(
+            title=_("Failed to render {0} {1} as PDF").format(doctype, name), message=frappe.get_traceback()
+        )
+        return None
+
+    return {
+        "mimetype": "application/pdf",
+        "filename": f"{name}.pdf".replace("/", "-"),
+        "url": get_rendered_url(token),
+    }
+
+
+def render_once(doctype, name, print_format, token, path):
+    """Single-flight render: one sender renders, concurrent ones wait for its file."""
+
+    def produce():
+        # Someone may have finished between our check and taking the lock
+        if not os.path.exists(path):
+            pdf = frappe.get_print(doctype, name, print_format, as_pdf=True)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written aside and renamed, so no one ever reads half a PDF
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(pdf)
+            os.replace(temp_path, path)
+            evict_rendered_pdfs()
+        return path
+
+    single_flight(
+        frappe.cache().make_key(f"{RENDER_LOCK_KEY}:{token}"),
+        RENDER_LOCK_TTL,
+        produce,
+        lambda: path if os.path.exists(path) else None,
+        frappe.ValidationError(_("Timed out waiting for {0} {1} to be rendered").format(doctype, name)),
+        poll=0.2,
+    )
+
+
+def evict_rendered_pdfs():
+    """Delete the least recently used rendered PDFs until the cache fits its size cap.
+
+    Files used within RENDERED_LINK_TTL are kept even past the cap: a link to
+    them may be waiting for the provider to download it.
+    """
+    size_mb = cint(get_settings(FOUR_WHATS_SETTINGS).get("pdf_cache_size_mb")) or DEFAULT_PDF_CACHE_SIZE_MB
+    entries = []
+    with os.scandir(get_rendered_path()) as scan:
+        for entry in scan:
+            if entry.name.endswith(".pdf"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+
+    total = sum(entry[2] for entry in entries)
+    in_use_since = time.time() - RENDERED_LINK_TTL
+    # Oldest use first; `utime` on every hit keeps the mtime current
+    for mtime, path, size in sorted(entries):
+        if total <= size_mb * 1024 * 1024 or mtime > in_use_since:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Another worker evicted it first
+            pass
+        total -= size
+
+
+def get_render_token(doctype, name, print_format, modified):
+    # Keyed with the site's encryption key: the name alone must not tell which document it is
+    return sign(f"{doctype}\n{name}\n{print_format}\n{modified}")
+
+
+def get_rendered_path(token=None):
+    directory = frappe.get_site_path("private", "files", PDF_CACHE_DIR)
+    return os.path.join(directory, f"{token}.pdf") if token else directory
+
+
+def get_rendered_url(token):
+    """A link to a rendered PDF that works for RENDERED_LINK_TTL seconds."""
+    expires = int(time.time()) + RENDERED_LINK_TTL
+    query = urlencode({"token": token, "expires": expires, "signature": sign(f"link\n{token}\n{expires}")})
+    return get_url(f"/api/method/four_whats_net.attachments.download_rendered_pdf?{query}")
+
+
+@frappe.whitelist(allow_guest=True, methods=["GET"])
+def download_rendered_pdf(token, expires, signature):
+    """Serve a rendered PDF to whoever holds an unexpired signed link to it."""
+    if not hmac.compare_digest(cstr(signature), sign(f"link\n{token}\n{expires}")) or cint(expires) < time.time():
+        raise frappe.PermissionError(_("This link is invalid or has expired"))
+
+    try:
+        with open(get_rendered_path(token), "rb") as f:
+            frappe.local.response.filecontent = f.read()
+    except FileNotFoundError:
+        raise frappe.DoesNotExistError(_("This document is no longer available"))
+    frappe.local.response.filename = f"{token}.pdf"
+    frappe.local.response.type = "pdf"
+
+
+def sign(value):
+    return hmac.new(get_encryption_key().encode(), value.encode(), hashlib.sha256).hexdigest()
+
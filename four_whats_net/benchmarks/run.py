@@ -0,0 +1,249 @@
+"""Send pipeline benchmarks against the in-process stub providers.
+
+Run on a scratch site with `allow_tests` enabled - the run writes message
+logs. Both providers are pointed at the stub servers for this process only;
+the stored configurations are never written:
+
+    bench --site bench.local execute four_whats_net.benchmarks.run.run
+    bench --site bench.local execute four_whats_net.benchmarks.run.run --kwargs "{'update_baseline': True}"
+
+Every benchmark reports throughput (operations or messages per second) and
+p50/p99 latency per operation. Results are compared with baseline.json next
+to this file; a throughput drop or p99 rise beyond `tolerance` raises
+`BenchmarkRegression`. `update_baseline` stores the current run instead.
+Timings depend on the machine, so no baseline ships with the app: record
+one on the machine that runs the benchmarks before comparing against it.
+"""
+
+import json
+import os
+import time
+from contextlib import contextmanager
+from unittest.mock import patch
+
+import frappe
+from frappe import _
+
+from four_whats_net import clients, settings
+from four_whats_net.benchmarks.stub_server import StubServer
+from four_whats_net.rendering import render_message
+from four_whats_net.tokens import invalidate_hormuud_token
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# Allowed slowdown against the baseline before a run fails
+TOLERANCE = 0.2
+
+
+class BenchmarkRegression(Exception):
+    pass
+
+
+def run(
+    documents=200,
+    recipients=5,
+    latency=0.02,
+    jitter=0.01,
+    error_rate=0.0,
+    concurrency=10,
+    iterations=20000,
+    update_baseline=False,
+    tolerance=TOLERANCE,
+):
+    """Run every benchmark, print the report and check it against the baseline."""
+    if not frappe.conf.allow_tests:
+        frappe.throw(_("Benchmarks write message logs; run them on a site with allow_tests"))
+    if not update_baseline and not os.path.exists(BASELINE_PATH):
+        frappe.throw(
+            _("No benchmark baseline at {0}; record one first with update_baseline").format(BASELINE_PATH)
+        )
+
+    results = {
+        "get_receiver_phone_number": bench_receiver_phone_number(iterations),
+        "render_message": bench_render(iterations),
+    }
+    with StubServer(latency, jitter, error_rate) as hormuud, StubServer(latency, jitter, error_rate) as four_whats:
+        with stub_providers(hormuud.url, four_whats.url, concurrency):
+            results["send_hormuud_sms"] = bench_send("SMSHormuud", documents, recipients)
+            results["send_whatsapp_msg"] = bench_send("4Whats.net", documents, recipients)
+
+    print(format_report(results))
+
+    if update_baseline:
+        with open(BASELINE_PATH, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print(f"Baseline written to {BASELINE_PATH}")
+        return results
+
+    regressions = compare(results, load_baseline(), tolerance)
+    if regressions:
+        raise BenchmarkRegression("\n".join(regressions))
+    return results
+
+
+def bench_receiver_phone_number(iterations):
+    notification = frappe.new_doc("Notification")
+    numbers = ["+252 61 5123456", "0615123456", "00252615123456", "+974 5512 3456", "615123456"]
+
+    timings = []
+    for i in range(iterations):
+        number = numbers[i % len(numbers)]
+        start = time.perf_counter()
+        notification.get_receiver_phone_number(number)
+        timings.append(time.perf_counter() - start)
+    return summarize(timings, iterations)
+
+
+def bench_render(iterations):
+    notification = make_notification("SMSHormuud", 1)
+    context = {"doc": make_document(0, 1), "alert": notification, "comments": None}
+
+    timings = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        render_message(notification, context)
+        timings.append(time.perf_counter() - start)
+    return summarize(timings, iterations)
+
+
+def bench_send(channel, documents, recipients):
+    """Drive ERPGulfNotification.send end to end, one document at a time."""
+    notification = make_notification(channel, recipients)
+    run_id = frappe.generate_hash(length=8)
+
+    timings = []
+    for i in range(documents):
+        doc = make_document(f"{run_id}-{i}", recipients)
+        if channel == "4Whats.net":
+            # Stands in for the attached PDF; the lookup itself is measured by the pipeline metrics
+            frappe.local.whatsapp_media = {
+                (doc.doctype, doc.name, None): {"mimetype": "application/pdf", "filename": "bench.pdf", "url": "https://example.com/bench.pdf"}
+            }
+        start = time.perf_counter()
+        notification.send(doc)
+        timings.append(time.perf_counter() - start)
+
+    frappe.local.whatsapp_media = None
+    # Messages per second, p50/p99 per document (i.e. per send() call)
+    return summarize(timings, documents * recipients)
+
+
+@contextmanager
+def stub_providers(hormuud_url, four_whats_url, concurrency):
+    """Point both providers at the stub servers, in this process only.
+
+    The settings snapshots are built from the stored configurations with the
+    stub values laid over them, and rebuilt from the untouched
+    configurations afterwards.
+    """
+    common = {
+        "send_in_background": 0,
+        "max_concurrent_requests": concurrency,
+        "pool_size": concurrency,
+        "rate_limit": 0,
+        # Stub errors must not open the breakers the real sends share
+        "circuit_breaker": 0,
+    }
+    overrides = {
+        "Hormuud SMS Configuration": {
+            **common, "api_url": f"{hormuud_url}/token", "username": "bench", "password": "bench", "grant_type": "password"
+        },
+        "Four Whats Net Configuration": {
+            **common, "api_url": four_whats_url, "instance_id": "bench", "token": "bench", "instance_rate_limit": 0
+        },
+    }
+    build_settings = settings.build_settings
+
+    def build_stub_settings(doctype):
+        return settings.Settings({**build_settings(doctype), **overrides.get(doctype, {})})
+
+    sms_url = clients.HORMUUD_SMS_URL
+    clients.HORMUUD_SMS_URL = f"{hormuud_url}/api/SendSMS"
+    reset_providers(overrides)
+    try:
+        with patch.object(settings, "build_settings", build_stub_settings):
+            yield
+    finally:
+        clients.HORMUUD_SMS_URL = sms_url
+        reset_providers(overrides)
+
+
+def reset_providers(doctypes):
+    for doctype in doctypes:
+        settings.drop_snapshot(doctype)
+    # The stub's token must never be used against the real endpoint, nor the real one against the stub
+    invalidate_hormuud_token()
+
+
+def make_notification(channel, recipients):
+    """An unsaved Notification with one phone field per recipient."""
+    notification = frappe.new_doc("Notification")
+    notification.update({
+        "name": f"Benchmark {channel}",
+        "subject": "Benchmark",
+        "document_type": "ToDo",
+        "event": "New",
+        "channel": channel,
+        "enabled": 1,
+        "modified": "2026-01-01 00:00:00",
+        "message": "Hello {{ doc.customer_name }}, invoice {{ doc.name }} of {{ doc.grand_total }} is due on {{ doc.due_date }}.",
+    })
+    for i in range(recipients):
+        notification.append("recipients", {"receiver_by_document_field": f"phone_{i}"})
+    return notification
+
+
+def make_document(name, recipients):
+    doc = frappe._dict(
+        doctype="ToDo",
+        name=f"BENCH-{name}",
+        customer_name="Benchmark Customer",
+        grand_total=1250.5,
+        due_date="2026-12-31",
+    )
+    for i in range(recipients):
+        doc[f"phone_{i}"] = f"2526{15000000 + i:08d}"
+    return doc
+
+
+def summarize(timings, operations):
+    ordered = sorted(timings)
+    total = sum(timings)
+    return {
+        "throughput": round(operations / total, 2) if total else 0,
+        "p50_ms": round(percentile(ordered, 50) * 1000, 4),
+        "p99_ms": round(percentile(ordered, 99) * 1000, 4),
+    }
+
+
+def percentile(ordered, pct):
+    if not ordered:
+        return 0
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def load_baseline():
+    with open(BASELINE_PATH) as f:
+        return json.load(f)
+
+
+def compare(results, baseline, tolerance):
+    """Return a line per benchmark that is slower than its baseline beyond `tolerance`."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {result['throughput']}/s, baseline {base['throughput']}/s")
+        if result["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {result['p99_ms']} ms, baseline {base['p99_ms']} ms")
+    return regressions
+
+
+def format_report(results):
+    lines = [f"{'benchmark':<28}{'per sec':>12}{'p50 ms':>12}{'p99 ms':>12}"]
+    for name, result in results.items():
+        lines.append(f"{name:<28}{result['throughput']:>12}{result['p50_ms']:>12}{result['p99_ms']:>12}")
+    return "\n".join(lines)
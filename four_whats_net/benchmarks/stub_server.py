@@ -0,0 +1,78 @@
+"""In-process stand-ins for the Hormuud and 4Whats.net HTTP APIs.
+
+Each `StubServer` listens on 127.0.0.1 on a free port in a daemon thread and
+answers like the real provider would, after `latency` seconds (plus up to
+`jitter`), failing a random `error_rate` share of requests with a 503.
+"""
+
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubServer:
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.message_id = 0
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                status, response = stub.handle(self.path.split("?", 1)[0], body)
+                data = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, path, body):
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+            self.message_id += 1
+            message_id = self.message_id
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            failed = self.random.random() < self.error_rate
+
+        time.sleep(delay)
+        if path == "/token":
+            # Tokens are never failed: the benchmark measures sends, not auth
+            return 200, {"access_token": f"stub-token-{message_id}", "token_type": "bearer", "expires_in": 3600}
+        if failed:
+            return 503, {"error": "Service Unavailable"}
+        if path == "/api/SendSMS":
+            return 200, {"ResponseCode": "200", "ResponseMessage": "SUCCESS!.", "Data": {"MessageID": message_id}}
+        if path == "/api/sendFile":
+            return 200, {"sent": True, "id": f"true_{message_id}@c.us"}
+        return 404, {"error": f"Unknown path {path}"}
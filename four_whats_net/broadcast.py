@@ -0,0 +1,256 @@
+"""Bulk broadcasts to recipients read from a DocType query, a report or a CSV file.
+
+A Notification Broadcast is sent by one background job that streams its
+recipients in chunks of CHUNK_SIZE through the usual normalize / render /
+deliver path, so memory stays flat however many recipients there are.
+After every chunk the counters and a checkpoint are committed; a broadcast
+whose worker died is picked up again from its checkpoint by the scheduler.
+"""
+
+import csv
+import json
+from itertools import islice
+
+import frappe
+from frappe import _
+from frappe.utils import add_to_date, cint, cstr, now_datetime
+
+from four_whats_net.attachments import get_whatsapp_media
+from four_whats_net.message_log import flush_log_buffer, make_idempotency_key
+from four_whats_net.phone import is_somali_mobile, normalize_many
+from four_whats_net.rendering import get_template
+from four_whats_net.routing import route_and_deliver
+
+BROADCAST = "Notification Broadcast"
+
+CHUNK_SIZE = 500
+
+# The running job refreshes its lock after every chunk; a lock left to
+# expire means the worker is gone and the broadcast can be resumed
+LOCK_TTL = 10 * 60
+
+
+@frappe.whitelist()
+def create_broadcast(channel, message, source_type, phone_field, source_doctype=None, report=None, filters=None, csv_file=None):
+    """Create a broadcast and start sending it in the background. Returns its name."""
+    broadcast = frappe.get_doc({
+        "doctype": BROADCAST,
+        "channel": channel,
+        "message": message,
+        "source_type": source_type,
+        "phone_field": phone_field,
+        "source_doctype": source_doctype,
+        "report": report,
+        "filters": filters if isinstance(filters, str) or filters is None else json.dumps(filters),
+        "csv_file": csv_file,
+    }).insert()
+    start_broadcast(broadcast.name)
+    return broadcast.name
+
+
+@frappe.whitelist()
+def start_broadcast(name):
+    """Start a draft broadcast, or resume a failed one from its checkpoint."""
+    broadcast = frappe.get_doc(BROADCAST, name)
+    broadcast.check_permission("write")
+    if broadcast.status in ("Running", "Completed"):
+        frappe.throw(_("Broadcast {0} is already {1}").format(name, broadcast.status))
+    if broadcast.channel == "4Whats.net" and not get_whatsapp_media(BROADCAST, name):
+        # Otherwise every recipient would fail on its own, each with an Error Log
+        frappe.throw(_("Attach a PDF to broadcast {0} before sending it over 4Whats.net").format(name))
+
+    broadcast.db_set({"status": "Queued", "error": None})
+    enqueue_broadcast(name)
+
+
+def enqueue_broadcast(name):
+    frappe.enqueue(
+        "four_whats_net.broadcast.run_broadcast",
+        queue="long",
+        timeout=6 * 60 * 60,
+        enqueue_after_commit=True,
+        name=name,
+    )
+
+
+def resume_stalled_broadcasts():
+    """Scheduler hook: re-enqueue broadcasts whose worker stopped without finishing."""
+    cache = frappe.cache()
+    stalled = frappe.get_all(
+        BROADCAST,
+        filters={"status": ["in", ["Queued", "Running"]], "modified": ["<", add_to_date(now_datetime(), minutes=-5)]},
+        pluck="name",
+    )
+    if not stalled:
+        return
+
+    # Raw EXISTS: RedisWrapper.exists would prefix the already prefixed keys again
+    pipeline = cache.pipeline()
+    for name in stalled:
+        pipeline.exists(get_lock_key(name))
+    for name, locked in zip(stalled, pipeline.execute()):
+        if not locked:
+            enqueue_broadcast(name)
+
+
+def get_lock_key(name):
+    return frappe.cache().make_key(f"four_whats_net:broadcast:{name}")
+
+
+def run_broadcast(name):
+    cache = frappe.cache()
+    lock_key = get_lock_key(name)
+    # Only one worker per broadcast, however many times it was enqueued
+    if not cache.set(lock_key, 1, nx=True, ex=LOCK_TTL):
+        return
+
+    try:
+        broadcast = frappe.get_doc(BROADCAST, name)
+        if broadcast.status not in ("Queued", "Running"):
+            return
+
+        broadcast.db_set("status", "Running", commit=True)
+        media = get_whatsapp_media(BROADCAST, name) if broadcast.channel == "4Whats.net" else None
+        if broadcast.channel == "4Whats.net" and not media:
+            # The PDF was removed after the broadcast was started
+            frappe.throw(_("Broadcast {0} has no PDF attached").format(name))
+
+        for rows, checkpoint in iter_recipients(broadcast):
+            sent, failed, skipped = send_chunk(broadcast, rows, media)
+            frappe.db.sql(
+                """update `tabNotification Broadcast`
+                set processed = processed + %(processed)s, sent = sent + %(sent)s,
+                    failed = failed + %(failed)s, skipped = skipped + %(skipped)s,
+                    checkpoint = %(checkpoint)s, modified = %(now)s
+                where name = %(name)s""",
+                {
+                    "processed": len(rows),
+                    "sent": sent,
+                    "failed": failed,
+                    "skipped": skipped,
+                    "checkpoint": checkpoint,
+                    "now": now_datetime(),
+                    "name": name,
+                },
+            )
+            frappe.db.commit()
+            cache.expire(lock_key, LOCK_TTL)
+
+        frappe.db.set_value(BROADCAST, name, "status", "Completed")
+        frappe.db.commit()
+    except Exception as e:
+        frappe.db.rollback()
+        frappe.log_error(title=_("Broadcast {0} failed").format(name), message=frappe.get_traceback())
+        frappe.db.set_value(BROADCAST, name, {"status": "Failed", "error": str(e)})
+        frappe.db.commit()
+    finally:
+        cache.delete(lock_key)
+
+
+def send_chunk(broadcast, rows, media):
+    """Send one chunk of recipient rows; returns (sent, failed, skipped) counts."""
+    template = get_template(broadcast, broadcast.message)
+    numbers = [cstr(row.get(broadcast.phone_field)) for row in rows]
+
+    messages = []
+    for row, phone_number in zip(rows, normalize_many(numbers)):
+        if not phone_number or (broadcast.channel == "SMSHormuud" and not is_somali_mobile(phone_number)):
+            continue
+        message = template.render({"doc": row, "broadcast": broadcast})
+        messages.append(frappe._dict(
+            phone_number=phone_number,
+            message=message,
+            media=media,
+            reference_doctype=BROADCAST,
+            reference_name=broadcast.name,
+            # A resumed broadcast re-reads at most one chunk; these keys stop it re-sending it
+            idempotency_key=make_idempotency_key(
+                broadcast.name, BROADCAST, broadcast.name, "Broadcast", phone_number, message
+            ),
+        ))
+
+    try:
+        route_and_deliver(broadcast.channel, messages)
+    finally:
+        flush_log_buffer()
+
+    sent = sum(1 for message in messages if message.status == "Sent")
+    failed = sum(1 for message in messages if message.error and message.status != "Suppressed")
+    # Duplicates and suppressed numbers are skipped, like rows without a usable number
+    skipped = sum(1 for message in messages if message.duplicate or message.status == "Suppressed")
+    return sent, failed, len(rows) - len(messages) + skipped
+
+
+def iter_recipients(broadcast):
+    """Yield (rows, checkpoint) chunks, starting after the broadcast's checkpoint."""
+    if broadcast.source_type == "DocType":
+        return iter_doctype_rows(broadcast)
+    elif broadcast.source_type == "Report":
+        return iter_report_rows(broadcast)
+    return iter_csv_rows(broadcast)
+
+
+def iter_doctype_rows(broadcast):
+    # Keyset pagination on name: every chunk is an index range scan, no OFFSET
+    filters = get_filter_list(broadcast.filters)
+    last_name = broadcast.checkpoint
+    while True:
+        chunk_filters = filters + ([["name", ">", last_name]] if last_name else [])
+        rows = frappe.get_all(
+            broadcast.source_doctype,
+            filters=chunk_filters,
+            fields=["*"],
+            order_by="name asc",
+            limit=CHUNK_SIZE,
+        )
+        if not rows:
+            return
+        last_name = rows[-1].name
+        yield rows, last_name
+
+
+def iter_report_rows(broadcast):
+    # Query and script reports can only be run whole; their rows are then sent in chunks
+    from frappe.desk.query_report import run
+
+    result = run(broadcast.report, filters=broadcast.filters or "{}", ignore_prepared_report=True)
+    fieldnames = [get_column_fieldname(column) for column in result.get("columns") or []]
+    rows = result.get("result") or []
+
+    offset = cint(broadcast.checkpoint)
+    while offset < len(rows):
+        chunk = [
+            frappe._dict(row) if isinstance(row, dict) else frappe._dict(zip(fieldnames, row))
+            for row in rows[offset : offset + CHUNK_SIZE]
+        ]
+        offset += len(chunk)
+        yield chunk, offset
+
+
+def iter_csv_rows(broadcast):
+    path = frappe.get_doc("File", {"file_url": broadcast.csv_file}).get_full_path()
+    offset = cint(broadcast.checkpoint)
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
+        rows = islice(reader, offset, None)
+        while True:
+            chunk = [frappe._dict(row) for row in islice(rows, CHUNK_SIZE)]
+            if not chunk:
+                return
+            offset += len(chunk)
+            yield chunk, offset
+
+
+def get_filter_list(filters):
+    """Turn JSON filters (dict or list form) into a list frappe.get_all accepts."""
+    filters = json.loads(filters) if filters else []
+    if isinstance(filters, dict):
+        return [[key, *value] if isinstance(value, list) else [key, "=", value] for key, value in filters.items()]
+    return filters
+
+
+def get_column_fieldname(column):
+    if isinstance(column, dict):
+        return column.get("fieldname") or frappe.scrub(column.get("label", ""))
+    # Old style "Label:Fieldtype/Options:Width"
+    return frappe.scrub(column.split(":")[0])
@@ -0,0 +1,199 @@
+"""Per-provider circuit breakers.
+
+A breaker opens when, within the last WINDOW seconds, at least `min
+requests` went out and `error rate` percent of them failed with an outage
+error (the retryable kind), or when `timeout streak` requests in a row
+timed out or could not connect. While it is open every worker fails its
+requests to that provider at once with `CircuitOpen`, which the delivery
+path treats like any retryable failure - the message is deferred to the
+retry scheduler, no earlier than the breaker's reopening - and routing
+treats as an unhealthy channel.
+
+After `open seconds` the breaker is half-open: `probes` requests are let
+through. They all succeeding closes it; any of them failing opens it again.
+
+State lives in one Redis hash per provider and every transition happens in
+a Lua script, so all web and background workers share one breaker.
+"""
+
+import time
+
+import frappe
+from frappe.utils import cint, flt
+
+from four_whats_net.utils import RedisScript, get_redis_key
+
+CIRCUIT_KEY = "four_whats_net:circuit"
+
+# Seconds of traffic the error rate is measured over
+WINDOW = 60
+
+DEFAULT_ERROR_RATE = 50
+DEFAULT_MIN_REQUESTS = 20
+DEFAULT_TIMEOUT_STREAK = 5
+DEFAULT_OPEN_SECONDS = 30
+DEFAULT_PROBES = 3
+
+# Returns {allowed, retry at}
+ALLOW_SCRIPT = """
+local open_seconds = tonumber(ARGV[1])
+local probes = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local state = redis.call('HGET', KEYS[1], 'state')
+if state == 'open' then
+    local retry_at = tonumber(redis.call('HGET', KEYS[1], 'retry_at'))
+    if now < retry_at then
+        return {0, tostring(retry_at)}
+    end
+    state = 'half_open'
+    redis.call('HSET', KEYS[1], 'state', state, 'retry_at', tostring(now + open_seconds), 'probes', 0, 'successes', 0)
+elseif state == 'half_open' and now >= tonumber(redis.call('HGET', KEYS[1], 'retry_at')) then
+    -- Probes that never reported back (a worker died): start a new round
+    redis.call('HSET', KEYS[1], 'retry_at', tostring(now + open_seconds), 'probes', 0, 'successes', 0)
+end
+
+if state == 'half_open' then
+    if redis.call('HINCRBY', KEYS[1], 'probes', 1) > probes then
+        -- Enough probes are out; the rest wait for their verdict
+        return {0, tostring(now + 1)}
+    end
+end
+return {1, '0'}
+"""
+
+# Returns the state after the request: 'closed', 'half_open' or 'open'
+RECORD_SCRIPT = """
+local failed = ARGV[1] == '1'
+local timed_out = ARGV[2] == '1'
+local error_rate = tonumber(ARGV[3])
+local min_requests = tonumber(ARGV[4])
+local timeout_streak = tonumber(ARGV[5])
+local window = tonumber(ARGV[6])
+local open_seconds = tonumber(ARGV[7])
+local probes = tonumber(ARGV[8])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local function open()
+    redis.call('DEL', KEYS[1])
+    redis.call('HSET', KEYS[1], 'state', 'open', 'retry_at', tostring(now + open_seconds))
+    redis.call('EXPIRE', KEYS[1], 24 * 60 * 60)
+    return 'open'
+end
+
+local state = redis.call('HGET', KEYS[1], 'state')
+if state == 'open' then
+    return state
+end
+if state == 'half_open' then
+    if failed then
+        return open()
+    end
+    if redis.call('HINCRBY', KEYS[1], 'successes', 1) >= probes then
+        redis.call('DEL', KEYS[1])
+        return 'closed'
+    end
+    return state
+end
+
+local window_start = tonumber(redis.call('HGET', KEYS[1], 'window_start'))
+if not window_start or now - window_start > window then
+    redis.call('HSET', KEYS[1], 'window_start', tostring(now), 'requests', 0, 'errors', 0)
+end
+local requests = redis.call('HINCRBY', KEYS[1], 'requests', 1)
+local errors = redis.call('HINCRBY', KEYS[1], 'errors', failed and 1 or 0)
+local streak = 0
+if timed_out then
+    streak = redis.call('HINCRBY', KEYS[1], 'streak', 1)
+else
+    redis.call('HSET', KEYS[1], 'streak', 0)
+end
+redis.call('EXPIRE', KEYS[1], 24 * 60 * 60)
+
+if timeout_streak > 0 and streak >= timeout_streak then
+    return open()
+end
+if error_rate > 0 and requests >= min_requests and errors * 100 >= error_rate * requests then
+    return open()
+end
+return 'closed'
+"""
+
+
+class CircuitOpen(Exception):
+    def __init__(self, channel, retry_at):
+        super().__init__(f"Circuit breaker for {channel} is open, retry at {retry_at:.3f}")
+        self.retry_at = retry_at
+
+
+class CircuitBreaker:
+    """A provider's breaker, shared by every worker through Redis.
+
+    Its scripts are `RedisScript`s: build it on a thread with a frappe site
+    context, then `allow` / `record` from any thread.
+    """
+
+    def __init__(self, channel, settings):
+        self.channel = channel
+        self.enabled = cint(get_value(settings, "circuit_breaker", 1))
+        self.key = get_circuit_key(channel)
+        # 0 turns either trigger off, so only a missing value takes the default
+        self.error_rate = flt(get_value(settings, "circuit_error_rate", DEFAULT_ERROR_RATE))
+        self.min_requests = cint(settings.get("circuit_min_requests")) or DEFAULT_MIN_REQUESTS
+        self.timeout_streak = cint(get_value(settings, "circuit_timeout_streak", DEFAULT_TIMEOUT_STREAK))
+        self.open_seconds = cint(settings.get("circuit_open_seconds")) or DEFAULT_OPEN_SECONDS
+        self.probes = cint(settings.get("circuit_probes")) or DEFAULT_PROBES
+        self.allow_script = RedisScript(ALLOW_SCRIPT)
+        self.record_script = RedisScript(RECORD_SCRIPT)
+
+    def check(self):
+        """Raise CircuitOpen if the breaker is open; takes no probe slot."""
+        retry_at = get_open_until(self.channel) if self.enabled else None
+        if retry_at:
+            raise CircuitOpen(self.channel, retry_at)
+
+    def allow(self):
+        """Raise CircuitOpen unless a request may go out now (counting it as a probe if half-open)."""
+        if not self.enabled:
+            return
+        allowed, retry_at = self.allow_script.call([self.key], [self.open_seconds, self.probes])
+        if not allowed:
+            raise CircuitOpen(self.channel, retry_at)
+
+    def record(self, failed, timed_out):
+        """Report a request's outcome; returns the breaker's state after it."""
+        if not self.enabled:
+            return "closed"
+        return self.record_script.call(
+            [self.key],
+            [
+                int(failed),
+                int(timed_out),
+                self.error_rate,
+                self.min_requests,
+                self.timeout_streak,
+                WINDOW,
+                self.open_seconds,
+                self.probes,
+            ],
+        )
+
+
+def get_value(settings, fieldname, default):
+    value = settings.get(fieldname)
+    return default if value is None else value
+
+
+def get_open_until(channel):
+    """The unix time an open breaker lets probes through again, or None if it is not open."""
+    state, retry_at = frappe.cache().hmget(get_circuit_key(channel), ["state", "retry_at"])
+    if frappe.safe_decode(state) != "open":
+        return None
+    retry_at = float(retry_at)
+    return retry_at if retry_at > time.time() else None
+
+
+def get_circuit_key(channel):
+    return get_redis_key(f"{CIRCUIT_KEY}:{channel}")
@@ -0,0 +1,99 @@
+"""HTTP clients for the Hormuud SMS and 4Whats.net APIs.
+
+Every worker process keeps one pooled keep-alive `requests.Session` per
+provider, so a fan-out to many recipients reuses a handful of warm TCP/TLS
+connections instead of opening one per message. All calls carry the
+connect/read timeouts configured on the provider's settings doctype.
+"""
+
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from frappe.utils import cint, flt
+
+HORMUUD_SMS_URL = "https://smsapi.hormuud.com/api/SendSMS"
+
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_POOL_SIZE = 10
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(provider, pool_size=DEFAULT_POOL_SIZE):
+    """Return this process's pooled session for `provider`, creating it on first use."""
+    # Keyed on the pid as well so a forked worker never reuses its parent's sockets
+    key = (provider, pool_size, os.getpid())
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                # pool_block makes extra threads wait for a free connection
+                # rather than opening (and then discarding) new ones
+                adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, pool_block=True)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _sessions[key] = session
+    return session
+
+
+class ProviderClient:
+    provider = None
+
+    def __init__(self, settings):
+        self.timeout = (
+            flt(settings.get("connect_timeout")) or DEFAULT_CONNECT_TIMEOUT,
+            flt(settings.get("read_timeout")) or DEFAULT_READ_TIMEOUT,
+        )
+        self.session = get_session(self.provider, cint(settings.get("pool_size")) or DEFAULT_POOL_SIZE)
+
+    def post(self, url, **kwargs):
+        response = self.session.post(url, timeout=self.timeout, **kwargs)
+        response.raise_for_status()
+        return response
+
+
+class HormuudClient(ProviderClient):
+    provider = "SMSHormuud"
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.token_url = settings.api_url
+
+    def fetch_token(self, username, password, grant_type):
+        """Request a new access token; returns the provider's JSON response."""
+        response = self.post(
+            self.token_url,
+            data={"grant_type": grant_type, "username": username, "password": password},
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+        )
+        return response.json()
+
+    def send_sms(self, access_token, phone_number, message):
+        response = self.post(
+            HORMUUD_SMS_URL,
+            json={"mobile": phone_number, "message": message},
+            headers={"Content-Type": "application/json", "Authorization": f"Bearer {access_token}"},
+        )
+        return response.json()
+
+
+class FourWhatsClient(ProviderClient):
+    provider = "4Whats.net"
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.api_url = settings.api_url
+
+    def send_file(self, data):
+        return self.post(
+            f"{self.api_url}/api/sendFile",
+            data=data,
+            headers={"Content-Type": "application/json"},
+        )
@@ -0,0 +1,130 @@
+"""Digests for notifications with *Coalesce Messages* ticked.
+
+Such a notification does not send right away: its messages are recorded as
+Held dispatch jobs, released when the recipient's window closes (the window
+starts with the first message held for that recipient and channel). Every
+minute the due jobs are claimed, grouped per channel and phone number, and
+each group goes out as one digest - one provider request and one log row -
+with the documents' PDFs listed as links. A group of one is sent as is.
+
+Members keep their own idempotency keys: a repeat within the group is sent
+once, a member already sent (or being sent) is left out, and once a digest
+goes out its members count as sent, so none reaches the recipient twice -
+not even when the worker dies mid-batch and the jobs are held again.
+"""
+
+import frappe
+from frappe import _
+
+from four_whats_net.dispatch import claim_jobs, deliver_job_messages, make_job_message, mark_jobs_sent
+from four_whats_net.message_log import claim_messages, get_idempotency_cache_key, make_idempotency_key, mark_sent
+
+BATCH_SIZE = 500
+
+# Longer bursts are split into several digests so none gets unreadably long
+MAX_DIGEST_SIZE = 20
+
+
+def release_held_jobs(batch_size=BATCH_SIZE):
+    """Scheduler hook: send the held jobs whose window has closed, as digests."""
+    while True:
+        jobs = claim_jobs(batch_size, held=True)
+        if not jobs:
+            break
+
+        groups = {}
+        for job in jobs:
+            groups.setdefault((job.channel, job.phone), []).append(job)
+
+        messages = []
+        digests = []
+        skipped = []
+        for (channel, _phone), group in groups.items():
+            parts = claim_parts(channel, [make_job_message(job) for job in group], skipped)
+            for start in range(0, len(parts), MAX_DIGEST_SIZE):
+                chunk = parts[start : start + MAX_DIGEST_SIZE]
+                if len(chunk) == 1:
+                    # Sent as is, and `deliver` claims it again itself
+                    release_claims(part.idempotency_key for part in chunk)
+                    messages += chunk
+                else:
+                    digest = make_digest(chunk)
+                    messages.append(digest)
+                    digests.append(digest)
+
+        # Already delivered: nothing to send, but the jobs are done
+        mark_jobs_sent(skipped)
+        # Before the request: members have no log rows of their own, so a worker
+        # dying after the digest went out must not leave them claimable again
+        mark_sent(key for digest in digests for key in digest.member_keys)
+        deliver_job_messages(messages)
+        release_failed_members(digests)
+
+
+def claim_parts(channel, parts, skipped):
+    """The parts worth sending; the jobs of the rest are added to `skipped`.
+
+    A part repeating an earlier part's idempotency key (the notification
+    fired twice within the window) rides along with that part, so its job
+    settles with it. A part sent before, alone or in another digest, or
+    being sent by another worker right now, is dropped; the others stay
+    claimed, and count as sent unless their digest fails.
+    """
+    unique = []
+    by_key = {}
+    for part in parts:
+        kept = by_key.get(part.idempotency_key)
+        if kept:
+            kept.jobs += part.jobs
+            continue
+        if part.idempotency_key:
+            by_key[part.idempotency_key] = part
+        unique.append(part)
+
+    claimed = claim_messages(channel, unique)
+    skipped += [job for part in unique if part.duplicate for job in part.jobs]
+    return claimed
+
+
+def release_failed_members(digests):
+    """Release the members of digests that failed, so they can go out again."""
+    release_claims(key for digest in digests if digest.error for key in digest.member_keys)
+
+
+def release_claims(keys):
+    keys = [get_idempotency_cache_key(key) for key in keys if key]
+    if keys:
+        frappe.cache().delete(*keys)
+
+
+def make_digest(parts):
+    """One outbound message carrying every part for a recipient."""
+    first = parts[0]
+    jobs = [job for part in parts for job in part.jobs]
+    body = "\n\n".join(
+        [_("You have {0} new messages:").format(len(parts))]
+        + [f"{i}. {part.message}" for i, part in enumerate(parts, 1)]
+    )
+    attachments = [part.media for part in parts if part.media]
+    if attachments:
+        body += "\n\n" + "\n".join(
+            [_("Attachments:")] + [f"- {media['filename']}: {media['url']}" for media in attachments]
+        )
+
+    member_keys = [part.idempotency_key for part in parts if part.idempotency_key]
+    return frappe._dict(
+        jobs=jobs,
+        channel=first.channel,
+        phone_number=first.phone_number,
+        message=body,
+        # The provider request carries one file; the rest are linked in the text
+        media=attachments[0] if attachments else None,
+        # Same members, same digest: a re-claimed batch is not sent twice
+        idempotency_key=make_idempotency_key(
+            first.notification, "Digest", jobs[0], "Digest", first.phone_number, "\n".join(member_keys)
+        ),
+        member_keys=member_keys,
+        reference_doctype=first.reference_doctype,
+        reference_name=first.reference_name,
+        notification=first.notification,
+    )
@@ -0,0 +1,291 @@
+"""Send a batch of messages over one provider and record the outcome.
+
+Used by the inline send in `ERPGulfNotification`, the background dispatch
+workers, broadcasts and the retry scheduler. The provider HTTP calls run on
+a bounded thread pool; everything that touches frappe (token lookup,
+payload building, logging) stays on the calling thread. Each provider has
+a circuit breaker: while it is open, messages are deferred to the retry
+scheduler at once instead of each waiting for the provider to time out.
+
+Every message ends up in the provider's message log: Sent, Suppressed
+(its number is on the suppression list, so it was never sent) or - when
+its request failed - Retrying with a backoff, Failed (the provider
+rejected it for good) or Dead (out of retries).
+"""
+
+import json
+import random
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import frappe
+from frappe import _
+from frappe.utils import add_to_date, cint, now_datetime
+
+from four_whats_net import metrics
+from four_whats_net.circuit import CircuitBreaker, CircuitOpen
+from four_whats_net.clients import FourWhatsClient, HormuudClient
+from four_whats_net.health import record_health
+from four_whats_net.message_log import LOG_DOCTYPES, claim_messages, get_log_buffer, make_log_row, settle_claims
+from four_whats_net.rate_limit import RateLimitExceeded, get_rate_limiter
+from four_whats_net.settings import get_settings
+from four_whats_net.suppression import MessageSuppressed, get_suppression
+from four_whats_net.tokens import TokenUnavailable, get_hormuud_token, invalidate_hormuud_token
+
+CHANNEL_SETTINGS = {
+    "SMSHormuud": "Hormuud SMS Configuration",
+    "4Whats.net": "Four Whats Net Configuration",
+}
+
+# Where Hormuud ({"Data": {"MessageID": ...}}) and 4Whats ({"id": ...}) put the message id
+PROVIDER_MESSAGE_ID_KEYS = ("MessageID", "messageId", "message_id", "id")
+
+# Exponential backoff: RETRY_BASE_DELAY * 2^n seconds, capped, with jitter
+MAX_RETRIES = 8
+RETRY_BASE_DELAY = 60
+RETRY_MAX_DELAY = 6 * 60 * 60
+
+
+def deliver(channel, messages, wait=True):
+    """Send every message over `channel` and log it.
+
+    `messages` are dicts with `phone_number` and `message` (plus `media` for
+    4Whats.net, and optionally `idempotency_key`, `reference_doctype` and
+    `reference_name`). Each one comes back with `status` and either
+    `response`, `error` (the exception its request failed with) or
+    `duplicate` (it had already been sent); one failure never stops the rest.
+
+    Messages being retried carry the `log_name` of their existing log row,
+    which is updated instead of a new one being written. Without `wait` a
+    message the rate limit holds back is deferred to the retry scheduler
+    instead of waiting for its token.
+    """
+    allowed = drop_suppressed(channel, messages)
+    pending = claim_messages(channel, allowed)
+    if len(pending) < len(allowed):
+        metrics.count("four_whats_messages_total", channel, "Duplicate", len(allowed) - len(pending))
+    if not pending:
+        return messages
+
+    try:
+        send_pending(channel, pending, wait)
+    except Exception as e:
+        # Failed before the requests went out (settings, token, open circuit breaker, ...)
+        if not isinstance(e, CircuitOpen):
+            frappe.log_error(title=_("Failed to send {0} messages").format(channel), message=frappe.get_traceback())
+            if is_retryable(e):
+                # e.g. the token endpoint is down: the provider is, as far as routing is concerned
+                record_health(channel, len(pending), len(pending), 0)
+        for message in pending:
+            if message.get("response") is None and message.get("error") is None:
+                message.error = e
+                record_result(channel, message)
+    finally:
+        settle_claims(pending)
+
+    return messages
+
+
+def drop_suppressed(channel, messages):
+    """Log the messages to suppressed numbers without sending them; return the rest."""
+    allowed = []
+    for message in messages:
+        reason = get_suppression(channel, message.phone_number)
+        if reason:
+            message.error = MessageSuppressed(message.phone_number, channel, reason)
+            record_result(channel, message)
+        else:
+            allowed.append(message)
+    return allowed
+
+
+def send_pending(channel, messages, wait=True):
+    settings = get_settings(CHANNEL_SETTINGS[channel])
+    # Shared with every worker through Redis; without `wait` a refused request is deferred, not waited for
+    limiter = get_rate_limiter(channel, settings)
+    breaker = CircuitBreaker(channel, settings)
+    # An open breaker defers the whole batch before we even ask for a token
+    breaker.check()
+
+    if channel == "SMSHormuud":
+        client = HormuudClient(settings)
+        access_token = get_hormuud_token()
+
+        def send(message):
+            return guarded_request(
+                breaker, limiter, wait, message, client.send_sms, access_token, message.phone_number, message.message
+            )
+
+    else:
+        client = FourWhatsClient(settings)
+        for message in messages:
+            message.payload = json.dumps(get_whatsapp_payload(settings, message)) if message.media else None
+
+        def send(message):
+            if message.payload is None:
+                raise ValueError(f"No PDF attachment to send to {message.phone_number}")
+            return guarded_request(breaker, limiter, wait, message, client.send_file, message.payload)
+
+    results = fan_out(send, messages, cint(settings.get("max_concurrent_requests")) or 1)
+    request_count = error_count = total_latency = 0
+    for message, (response, error) in zip(messages, results):
+        message.response, message.error = response, error
+        # Timed on the worker threads, recorded here where frappe.local is available
+        if message.rate_limit_seconds is not None:
+            metrics.observe("rate_limit", channel, message.rate_limit_seconds)
+        if message.http_seconds is not None:
+            metrics.observe("http", channel, message.http_seconds)
+            status = (get_status_code(error) or type(error).__name__) if error else 200
+            metrics.count("four_whats_requests_total", channel, status)
+            request_count += 1
+            total_latency += message.http_seconds
+            error_count += bool(error and is_retryable(error))
+        record_result(channel, message)
+    record_health(channel, request_count, error_count, total_latency)
+
+
+def guarded_request(breaker, limiter, wait, message, request, *args):
+    """Send one request through the circuit breaker and the rate limiter."""
+    # Before the rate limit, so a deferred message never spends a token
+    breaker.allow()
+    wait_for_token(limiter, wait, message)
+    try:
+        response = timed_request(message, request, *args)
+    except Exception as e:
+        breaker.record(is_retryable(e), isinstance(e, (requests.ConnectionError, requests.Timeout)))
+        raise
+    breaker.record(False, False)
+    return response
+
+
+def wait_for_token(limiter, wait, message):
+    start = time.perf_counter()
+    try:
+        if wait:
+            limiter.acquire()
+        else:
+            limiter.try_acquire()
+    finally:
+        message.rate_limit_seconds = time.perf_counter() - start
+
+
+def timed_request(message, request, *args):
+    start = time.perf_counter()
+    try:
+        return request(*args)
+    finally:
+        message.http_seconds = time.perf_counter() - start
+
+
+def fan_out(send, items, max_workers):
+    """Call `send(item)` for every item with at most `max_workers` in flight.
+
+    Returns a (result, exception) pair per item, in input order.
+    """
+
+    def call(item):
+        try:
+            return send(item), None
+        except Exception as e:
+            return None, e
+
+    if max_workers <= 1 or len(items) <= 1:
+        return [call(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(call, items))
+
+
+def get_whatsapp_payload(settings, message):
+    return {
+        "session": settings.instance_id,  # Session ID from the settings
+        "caption": message.message,
+        "chatId": f"{message.phone_number}@c.us",
+        "file": message.media,
+    }
+
+
+def record_result(channel, message):
+    """Set the message's delivery status and queue its log row (new messages only)."""
+    if message.error:
+        if channel == "SMSHormuud" and get_status_code(message.error) == 401:
+            # Token revoked or expired early; the next send fetches a new one
+            invalidate_hormuud_token()
+
+        message.status, message.next_retry_at = get_failure_state(message.error, cint(message.retry_count))
+        if message.status not in ("Retrying", "Suppressed"):
+            title = _("Failed to send SMS via Hormuud API") if channel == "SMSHormuud" else _("Failed to send WhatsApp message")
+            frappe.log_error(title=title, message="".join(traceback.format_exception(message.error)))
+    else:
+        message.status = "Sent"
+        message.provider_message_id = get_provider_message_id(message.response)
+        if channel == "SMSHormuud" and message.response.get("ResponseMessage") != "SUCCESS!.":
+            frappe.log_error(message.response, "SMS API Response Error")
+
+    metrics.count("four_whats_messages_total", channel, message.status)
+    if message.log_name:
+        get_log_buffer().update(LOG_DOCTYPES[channel], message.log_name, {
+            "status": message.status,
+            "retry_count": cint(message.retry_count),
+            "next_retry_at": message.next_retry_at,
+            "last_error": str(message.error) if message.error else None,
+            "provider_message_id": message.provider_message_id,
+        })
+    else:
+        get_log_buffer().add(LOG_DOCTYPES[channel], make_log_row(channel, message))
+
+
+def get_provider_message_id(response):
+    """The id the provider's delivery receipts will refer to, if its response has one."""
+    if isinstance(response, requests.Response):
+        try:
+            response = response.json()
+        except ValueError:
+            return None
+    if not isinstance(response, dict):
+        return None
+
+    data = response.get("Data") or response.get("data")
+    for source in (data, response):
+        if isinstance(source, dict):
+            for key in PROVIDER_MESSAGE_ID_KEYS:
+                if source.get(key):
+                    return str(source[key])
+    return None
+
+
+def get_status_code(error):
+    return getattr(getattr(error, "response", None), "status_code", None)
+
+
+def is_retryable(error):
+    """Outages, timeouts and throttling are worth retrying; a rejected request is not."""
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, RateLimitExceeded, CircuitOpen, TokenUnavailable)):
+        return True
+    status_code = get_status_code(error)
+    return status_code in (401, 408, 429) or (status_code or 0) >= 500
+
+
+def get_failure_state(error, retry_count):
+    """Return (status, next_retry_at) for a message that has failed `retry_count` retries so far."""
+    if isinstance(error, MessageSuppressed):
+        return "Suppressed", None
+    if not is_retryable(error):
+        return "Failed", None
+    if retry_count >= MAX_RETRIES:
+        return "Dead", None
+
+    # "Equal jitter": half the backoff is fixed, the other half random, so
+    # messages failed by the same outage do not all come back at once
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**retry_count)
+    delay = delay / 2 + random.uniform(0, delay / 2)
+
+    retry_at = getattr(error, "retry_at", None)
+    if retry_at:
+        # The rate limiter knows exactly when a token is free
+        delay = max(delay, retry_at - time.time())
+
+    return "Retrying", add_to_date(now_datetime(), seconds=delay)
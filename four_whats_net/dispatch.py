@@ -0,0 +1,241 @@
+"""Background dispatch of 4Whats.net / Hormuud SMS messages.
+
+When a provider configuration has *Send in Background* ticked,
+`ERPGulfNotification.send` only records one Notification Dispatch Job per
+recipient; the provider HTTP calls happen here, in RQ workers, outside the
+document's save transaction.
+"""
+
+import frappe
+from frappe.utils import add_to_date, cint, now_datetime
+
+from four_whats_net.attachments import clear_media_memo, get_notification_media
+from four_whats_net.delivery import CHANNEL_SETTINGS
+from four_whats_net.message_log import flush_log_buffer
+from four_whats_net.metrics import timer
+from four_whats_net.routing import route_and_deliver
+from four_whats_net.settings import get_settings
+from four_whats_net.utils import bulk_insert
+
+DISPATCH_JOB = "Notification Dispatch Job"
+
+BATCH_SIZE = 50
+
+# Jobs still "Processing" after this many minutes belong to a dead worker
+CLAIM_TIMEOUT = 10
+
+# Claims a job gets before one that keeps dying with its worker is given up on
+MAX_ATTEMPTS = 5
+
+
+def is_queued(channel):
+    """Return True if messages for `channel` should go through the dispatch queue."""
+    settings_doctype = CHANNEL_SETTINGS.get(channel)
+    if not settings_doctype:
+        return False
+    return bool(cint(get_settings(settings_doctype).send_in_background))
+
+
+def enqueue_jobs(notification, doc, channel, messages, hold_for=None):
+    """Record one dispatch job per outbound message and wake a worker.
+
+    With `hold_for` (seconds) the jobs are held instead, to be merged with
+    whatever else reaches the same recipients before the window closes
+    (see four_whats_net.coalesce).
+    """
+    release_at = get_release_times(channel, messages, hold_for) if hold_for else {}
+    rows = [
+        {
+            "status": "Held" if hold_for else "Queued",
+            "channel": channel,
+            "notification": notification.name,
+            "reference_doctype": doc.doctype,
+            "reference_name": doc.name,
+            "phone": message.phone_number,
+            "message": message.message,
+            "idempotency_key": message.idempotency_key,
+            "attempts": 0,
+            "release_at": release_at.get(message.phone_number),
+        }
+        for message in messages
+    ]
+    if not rows:
+        return []
+
+    names = bulk_insert(DISPATCH_JOB, rows)
+    if not hold_for:
+        frappe.enqueue(
+            "four_whats_net.dispatch.process_dispatch_jobs",
+            queue="short",
+            enqueue_after_commit=True,
+        )
+    return names
+
+
+def get_release_times(channel, messages, hold_for):
+    """{phone: release_at}: a recipient's window starts with the first message held for it."""
+    phones = list({message.phone_number for message in messages})
+    held = dict(frappe.db.sql(
+        """select phone, min(release_at) from `tabNotification Dispatch Job`
+        where status = 'Held' and channel = %(channel)s and phone in %(phones)s
+        group by phone""",
+        {"channel": channel, "phones": tuple(phones) or ("",)},
+    ))
+    release_at = add_to_date(now_datetime(), seconds=hold_for)
+    return {phone: held.get(phone) or release_at for phone in phones}
+
+
+def process_dispatch_jobs(batch_size=BATCH_SIZE):
+    """Drain queued dispatch jobs. Safe to run from several workers at once."""
+    release_stale_claims()
+    while True:
+        jobs = claim_jobs(batch_size)
+        if not jobs:
+            break
+        deliver_jobs(jobs)
+
+
+def claim_jobs(batch_size, held=False):
+    """Atomically mark up to `batch_size` queued (or due held) jobs as ours and return them."""
+    claim = frappe.generate_hash(length=12)
+    if held:
+        # A recipient's held jobs sit next to each other, so a batch rarely splits a digest
+        condition, order_by = "status = 'Held' and release_at <= %(now)s", "phone, creation"
+    else:
+        condition, order_by = "status = 'Queued'", "creation"
+    frappe.db.sql(
+        f"""
+        update `tabNotification Dispatch Job`
+        set status = 'Processing', claimed_by = %(claim)s, claimed_at = %(now)s,
+            attempts = attempts + 1
+        where {condition}
+        order by {order_by}
+        limit %(limit)s
+        """,
+        {"claim": claim, "now": now_datetime(), "limit": cint(batch_size)},
+    )
+    frappe.db.commit()
+
+    return frappe.get_all(
+        DISPATCH_JOB,
+        filters={"claimed_by": claim},
+        fields=[
+            "name",
+            "channel",
+            "notification",
+            "reference_doctype",
+            "reference_name",
+            "phone",
+            "message",
+            "idempotency_key",
+        ],
+        order_by="creation asc",
+    )
+
+
+def deliver_jobs(jobs):
+    deliver_job_messages([make_job_message(job) for job in jobs])
+
+
+def make_job_message(job):
+    message = frappe._dict(
+        jobs=[job.name],
+        channel=job.channel,
+        phone_number=job.phone,
+        message=job.message,
+        idempotency_key=job.idempotency_key,
+        reference_doctype=job.reference_doctype,
+        reference_name=job.reference_name,
+        notification=job.notification,
+    )
+    if job.channel == "4Whats.net":
+        with timer("attachment", job.channel):
+            message.media = get_notification_media(job.notification, job.reference_doctype, job.reference_name)
+    return message
+
+
+def deliver_job_messages(messages):
+    """Send messages built from dispatch jobs and settle every job they carry."""
+    by_channel = {}
+    for message in messages:
+        by_channel.setdefault(message.channel, []).append(message)
+
+    sent = []
+    for channel, channel_messages in by_channel.items():
+        route_and_deliver(channel, channel_messages)
+
+        for message in channel_messages:
+            if message.error:
+                # A retryable failure is picked up again by the retry scheduler from the message log
+                for job in message.jobs:
+                    frappe.db.set_value(
+                        DISPATCH_JOB,
+                        job,
+                        {"status": "Failed", "error": f"{message.status}: {message.error}"},
+                        update_modified=False,
+                    )
+            else:
+                sent += message.jobs
+
+    # One bulk write for the whole batch's message log rows
+    flush_log_buffer()
+    clear_media_memo()
+
+    mark_jobs_sent(sent)
+    frappe.db.commit()
+
+
+def mark_jobs_sent(names):
+    if names:
+        frappe.db.sql(
+            """update `tabNotification Dispatch Job` set status = 'Sent', modified = %(now)s
+            where name in %(names)s""",
+            {"now": now_datetime(), "names": tuple(names)},
+        )
+
+
+def release_stale_claims():
+    """Hand jobs claimed by a worker that died mid-batch back to the queue they came from.
+
+    A job that has been claimed MAX_ATTEMPTS times (e.g. one whose batch keeps
+    crashing the worker) is marked Failed instead.
+    """
+    values = {
+        "stale": add_to_date(now_datetime(), minutes=-CLAIM_TIMEOUT),
+        "max_attempts": MAX_ATTEMPTS,
+        "error": f"Gave up after {MAX_ATTEMPTS} attempts that never finished",
+    }
+    frappe.db.sql(
+        """
+        update `tabNotification Dispatch Job`
+        set status = 'Failed', claimed_by = null, error = %(error)s
+        where status = 'Processing' and claimed_at < %(stale)s and attempts >= %(max_attempts)s
+        """,
+        values,
+    )
+    frappe.db.sql(
+        """
+        update `tabNotification Dispatch Job`
+        set status = case when release_at is null then 'Queued' else 'Held' end, claimed_by = null
+        where status = 'Processing' and claimed_at < %(stale)s
+        """,
+        values,
+    )
+    frappe.db.commit()
+
+
+@frappe.whitelist()
+def get_dispatch_status(reference_doctype, reference_name):
+    """Return the dispatch jobs recorded for a document, with a count per status."""
+    frappe.has_permission(reference_doctype, doc=reference_name, throw=True)
+
+    jobs = frappe.get_all(
+        DISPATCH_JOB,
+        filters={"reference_doctype": reference_doctype, "reference_name": reference_name},
+        fields=["name", "channel", "phone", "status", "attempts", "error", "modified"],
+        order_by="creation asc",
+    )
+    counts = {}
+    for job in jobs:
+        counts[job.status] = counts.get(job.status, 0) + 1
+    return {"counts": counts, "jobs": jobs}
@@ -1,8 +1,18 @@
 # Copyright (c) 2023, hts-qatar and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
 class FourWhatsMessages(Document):
 	pass
+
+
+def on_doctype_update():
+	# Retention scans and purges the log one day at a time
+	frappe.db.add_index("Four Whats Messages", ["creation"])
+	# Message history lookups, newest first (see four_whats_net.history)
+	frappe.db.add_index("Four Whats Messages", ["phone", "creation"])
+	frappe.db.add_index("Four Whats Messages", ["reference_doctype", "reference_name", "creation"])
+	frappe.db.add_index("Four Whats Messages", ["notification", "creation"])
+	frappe.db.add_index("Four Whats Messages", ["status", "creation"])
@@ -1,8 +1,10 @@
 # Copyright (c) 2024, hts-qatar and contributors
 # For license information, please see license.txt
 
-# import frappe
 from frappe.model.document import Document
 
+from four_whats_net.settings import invalidate_settings
+
 class HormuudSMSConfiguration(Document):
-	pass
+	def on_update(self):
+		invalidate_settings(self.doctype)
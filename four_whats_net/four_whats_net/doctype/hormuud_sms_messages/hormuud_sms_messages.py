@@ -1,8 +1,18 @@
 # Copyright (c) 2024, hts-qatar and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
 class HormuudSMSMessages(Document):
 	pass
+
+
+def on_doctype_update():
+	# Retention scans and purges the log one day at a time
+	frappe.db.add_index("Hormuud SMS Messages", ["creation"])
+	# Message history lookups, newest first (see four_whats_net.history)
+	frappe.db.add_index("Hormuud SMS Messages", ["phone_number", "creation"])
+	frappe.db.add_index("Hormuud SMS Messages", ["doctype_name", "document_name", "creation"])
+	frappe.db.add_index("Hormuud SMS Messages", ["notification", "creation"])
+	frappe.db.add_index("Hormuud SMS Messages", ["status", "creation"])
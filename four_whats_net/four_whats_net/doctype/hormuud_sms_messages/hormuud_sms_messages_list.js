@@ -0,0 +1,24 @@
+// Copyright (c) 2026, hts-qatar and contributors
+// For license information, please see license.txt
+
+frappe.listview_settings['Hormuud SMS Messages'] = {
+	get_indicator: function(doc) {
+		const colors = { Sent: "green", Queued: "blue", Retrying: "orange", Failed: "red", Dead: "darkgrey", Suppressed: "grey" };
+		return [__(doc.status), colors[doc.status] || "grey", "status,=," + doc.status];
+	},
+	onload: function(listview) {
+		listview.page.add_actions_menu_item(__("Re-drive"), function() {
+			frappe.call({
+				method: "four_whats_net.retry.redrive",
+				args: {
+					doctype: listview.doctype,
+					names: listview.get_checked_items(true)
+				},
+				callback: function(r) {
+					frappe.show_alert(__("{0} message(s) queued for retry", [r.message]));
+					listview.refresh();
+				}
+			});
+		});
+	}
+};
@@ -1,9 +1,40 @@
 # Copyright (c) 2024, hts-qatar and Contributors
 # See license.txt
 
-# import frappe
+from unittest.mock import patch
+
+import requests
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
 
+from four_whats_net.delivery import deliver
+from four_whats_net.tokens import invalidate_hormuud_token
+
+SETTINGS = frappe._dict(
+	api_url="https://token.invalid/token",
+	username="user",
+	password="secret",
+	grant_type="password",
+	circuit_breaker=0,
+)
+
 
 class TestHormuudSMSMessages(FrappeTestCase):
-	pass
+	def test_token_outage_is_retried(self):
+		invalidate_hormuud_token()
+		message = frappe._dict(
+			phone_number="252612345678", message="Test", idempotency_key=frappe.generate_hash()
+		)
+
+		with patch("four_whats_net.delivery.get_settings", return_value=SETTINGS), patch(
+			"four_whats_net.tokens.get_settings", return_value=SETTINGS
+		), patch(
+			"four_whats_net.clients.HormuudClient.fetch_token",
+			side_effect=requests.ConnectionError("Token endpoint is down"),
+		):
+			deliver("SMSHormuud", [message])
+
+		# Picked up again by the retry scheduler, not dead-lettered as Failed
+		self.assertEqual(message.status, "Retrying")
+		self.assertTrue(message.next_retry_at)
@@ -0,0 +1,24 @@
+# Copyright (c) 2026, hts-qatar and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.model.document import Document
+
+from four_whats_net.phone import normalize
+from four_whats_net.suppression import get_suppression_key, publish_change
+
+class MessageSuppression(Document):
+	def before_insert(self):
+		# Messages carry normalized numbers, so the list must too
+		phone_number = normalize(self.phone_number)
+		if not phone_number:
+			frappe.throw(_("{0} is not a valid phone number").format(self.phone_number))
+		self.phone_number = phone_number
+		self.suppression_key = get_suppression_key(self.channel, self.phone_number)
+
+	def on_update(self):
+		frappe.db.after_commit.add(lambda: publish_change("add", self.channel, self.phone_number, self.reason))
+
+	def on_trash(self):
+		frappe.db.after_commit.add(lambda: publish_change("remove", self.channel, self.phone_number))
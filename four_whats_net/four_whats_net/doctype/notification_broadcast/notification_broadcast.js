@@ -0,0 +1,19 @@
+// Copyright (c) 2026, hts-qatar and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('Notification Broadcast', {
+	refresh: function(frm) {
+		if (!frm.is_new() && in_list(["Draft", "Failed"], frm.doc.status)) {
+			let label = frm.doc.status === "Draft" ? __("Start") : __("Resume");
+			frm.add_custom_button(label, function() {
+				frappe.call({
+					method: "four_whats_net.broadcast.start_broadcast",
+					args: { name: frm.doc.name },
+					callback: function() {
+						frm.reload_doc();
+					}
+				});
+			});
+		}
+	}
+});
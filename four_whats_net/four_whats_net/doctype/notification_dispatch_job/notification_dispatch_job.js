@@ -0,0 +1,8 @@
+// Copyright (c) 2026, hts-qatar and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('Notification Dispatch Job', {
+	// refresh: function(frm) {
+
+	// }
+});
@@ -0,0 +1,10 @@
+# Copyright (c) 2026, hts-qatar and contributors
+# For license information, please see license.txt
+
+from frappe.model.document import Document
+
+from four_whats_net.settings import invalidate_settings
+
+class NotificationRoutingSettings(Document):
+	def on_update(self):
+		invalidate_settings(self.doctype)
@@ -0,0 +1,67 @@
+"""Recent per-provider health: request count, error count and latency.
+
+`deliver` records every batch into per-minute Redis hashes shared by all
+workers; `get_health` sums the last few minutes. Routing reads it to skip a
+provider that is failing or slow right now, so only provider-side failures
+(the retryable kind) count as errors.
+"""
+
+import time
+
+import frappe
+
+HEALTH_KEY = "four_whats_net:provider_health"
+
+# Process-local cache of the summed window, so routing costs no Redis call per message
+HEALTH_CACHE_TTL = 5
+
+# (site, channel, window) -> (read_at, health)
+_health = {}
+
+
+def record_health(channel, requests, errors, latency):
+    """Add one batch's totals to the current minute's bucket."""
+    if not requests:
+        return
+
+    key = get_bucket_key(channel, int(time.time() // 60))
+    pipeline = frappe.cache().pipeline()
+    pipeline.hincrby(key, "requests", requests)
+    pipeline.hincrby(key, "errors", errors)
+    pipeline.hincrbyfloat(key, "latency", latency)
+    # Long enough for the widest window anyone reads
+    pipeline.expire(key, 60 * 60)
+    pipeline.execute()
+
+
+def get_health(channel, window=5):
+    """Return {"requests", "errors", "error_rate", "latency"} over the last `window` minutes."""
+    cache_key = (frappe.local.site, channel, window)
+    cached = _health.get(cache_key)
+    if cached and time.monotonic() - cached[0] < HEALTH_CACHE_TTL:
+        return cached[1]
+
+    minute = int(time.time() // 60)
+    pipeline = frappe.cache().pipeline()
+    for bucket in range(minute - window + 1, minute + 1):
+        pipeline.hgetall(get_bucket_key(channel, bucket))
+
+    requests = errors = latency = 0
+    for bucket in pipeline.execute():
+        bucket = {frappe.safe_decode(field): float(value) for field, value in (bucket or {}).items()}
+        requests += bucket.get("requests", 0)
+        errors += bucket.get("errors", 0)
+        latency += bucket.get("latency", 0)
+
+    health = frappe._dict(
+        requests=int(requests),
+        errors=int(errors),
+        error_rate=errors / requests if requests else 0,
+        latency=latency / requests if requests else 0,
+    )
+    _health[cache_key] = (time.monotonic(), health)
+    return health
+
+
+def get_bucket_key(channel, minute):
+    return frappe.cache().make_key(f"{HEALTH_KEY}:{channel}:{minute}")
@@ -0,0 +1,122 @@
+"""Message history search over both message logs.
+
+`get_message_history` answers "what did we send to this number / for this
+document / from this notification" newest first, a page at a time. Every
+filter it accepts leads one of the composite (..., creation) indexes the
+log doctypes create in `on_doctype_update`, and pages continue from a
+(creation, name) cursor instead of an OFFSET, so page 1000 costs the same
+as page 1 however large the logs are.
+"""
+
+import frappe
+from frappe import _
+from frappe.utils import cint, get_datetime
+
+from four_whats_net.message_log import LOG_DOCTYPES, LOG_FIELDS
+from four_whats_net.phone import normalize
+
+DEFAULT_PAGE_LENGTH = 50
+MAX_PAGE_LENGTH = 500
+
+# Returned with every message, besides the LOG_FIELDS columns
+EXTRA_FIELDS = ("status", "receipt_status", "retry_count", "last_error", "creation")
+
+
+@frappe.whitelist()
+def get_message_history(
+    phone_number=None,
+    reference_doctype=None,
+    reference_name=None,
+    notification=None,
+    status=None,
+    channel=None,
+    cursor=None,
+    page_length=DEFAULT_PAGE_LENGTH,
+):
+    """Return {"messages": [...], "next_cursor": ...}, newest first.
+
+    At least one of `phone_number`, `reference_doctype` + `reference_name`,
+    `notification` or `status` is required. Pass `next_cursor` back as
+    `cursor` for the next page; it is None on the last one.
+    """
+    if phone_number:
+        phone_number = normalize(phone_number)
+        if not phone_number:
+            frappe.throw(_("Invalid phone number"))
+    if reference_name and not reference_doctype:
+        frappe.throw(_("Reference Name needs a Reference Doctype"))
+    if not (phone_number or reference_name or notification or status):
+        frappe.throw(_("Filter by phone number, document, notification or status"))
+    if channel and channel not in LOG_DOCTYPES:
+        frappe.throw(_("Unknown channel {0}").format(channel))
+
+    page_length = min(max(cint(page_length) or DEFAULT_PAGE_LENGTH, 1), MAX_PAGE_LENGTH)
+    after = parse_cursor(cursor)
+
+    messages = []
+    for log_channel in [channel] if channel else LOG_DOCTYPES:
+        if not frappe.has_permission(LOG_DOCTYPES[log_channel], "read"):
+            continue
+        messages += query_log(
+            log_channel,
+            {
+                "phone_number": phone_number,
+                "reference_doctype": reference_doctype,
+                "reference_name": reference_name,
+                "notification": notification,
+            },
+            status,
+            after,
+            page_length,
+        )
+
+    # Each log returned its own newest page; merged, the first page_length are the real page
+    messages.sort(key=lambda message: (message.creation, message.name), reverse=True)
+    messages = messages[:page_length]
+    next_cursor = None
+    if len(messages) == page_length:
+        last = messages[-1]
+        next_cursor = f"{last.creation}|{last.name}"
+    return {"messages": messages, "next_cursor": next_cursor}
+
+
+def query_log(channel, filters, status, after, limit):
+    doctype = LOG_DOCTYPES[channel]
+    fields = LOG_FIELDS[channel]
+
+    conditions, values = [], {"limit": limit}
+    for key, value in filters.items():
+        if value:
+            conditions.append(f"`{fields[key]}` = %({key})s")
+            values[key] = value
+    if status:
+        conditions.append("status = %(status)s")
+        values["status"] = status
+    if after:
+        conditions.append("(creation < %(creation)s or (creation = %(creation)s and name < %(name)s))")
+        values.update(after)
+
+    columns = ", ".join(
+        [f"`{column}` as `{key}`" for key, column in fields.items()] + [f"`{field}`" for field in EXTRA_FIELDS]
+    )
+    messages = frappe.db.sql(
+        f"""select name, {columns}
+        from `tab{doctype}`
+        where {" and ".join(conditions)}
+        order by creation desc, name desc
+        limit %(limit)s""",
+        values,
+        as_dict=True,
+    )
+    for message in messages:
+        message.channel = channel
+    return messages
+
+
+def parse_cursor(cursor):
+    if not cursor:
+        return None
+    creation, separator, name = cursor.partition("|")
+    if not name:
+        frappe.throw(_("Invalid cursor"))
+    return {"creation": get_datetime(creation), "name": name}
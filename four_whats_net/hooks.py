@@ -14,6 +14,17 @@ fixtures = [{
 			]
 		]
 	]
+	},
+	{
+		"dt": "Custom Field", "filters": [
+		[
+			"name", "in", [
+				"Notification-coalesce_messages",
+				"Notification-coalesce_window",
+				"Notification-whatsapp_print_format",
+			]
+		]
+	]
 	}
 ,]
 
@@ -124,9 +135,42 @@ override_doctype_class = {
 #	}
 # }
 
+doc_events = {
+	"User": {
+		"on_update": "four_whats_net.recipients.invalidate_user_recipients",
+		"on_trash": "four_whats_net.recipients.invalidate_user_recipients"
+	},
+	"Contact": {
+		"on_update": "four_whats_net.recipients.invalidate_contact_recipients",
+		"on_trash": "four_whats_net.recipients.invalidate_contact_recipients"
+	},
+	"Has Role": {
+		"on_update": "four_whats_net.recipients.invalidate_role_recipients",
+		"on_trash": "four_whats_net.recipients.invalidate_role_recipients"
+	}
+}
+
 # Scheduled Tasks
 # ---------------
 
+scheduler_events = {
+	"all": [
+		"four_whats_net.dispatch.process_dispatch_jobs",
+		"four_whats_net.broadcast.resume_stalled_broadcasts"
+	],
+	"daily": [
+		"four_whats_net.retention.run_retention",
+		"four_whats_net.suppression.remove_expired_suppressions"
+	],
+	"cron": {
+		"* * * * *": [
+			"four_whats_net.retry.process_retries",
+			"four_whats_net.webhooks.apply_receipts",
+			"four_whats_net.coalesce.release_held_jobs"
+		],
+	},
+}
+
 # scheduler_events = {
 #	"all": [
 #		"four_whats_net.tasks.all"
@@ -0,0 +1,220 @@
+"""Buffered writes to the Four Whats Messages / Hormuud SMS Messages logs.
+
+Rows are collected while a dispatch runs and written with one multi-row
+INSERT per doctype and a single commit, instead of an insert and a commit
+per recipient.
+
+Every row also carries an idempotency key. Before a message goes to the
+provider its key is claimed in Redis and checked against the log's unique
+index, so a retried send or a notification that fires twice for the same
+event costs a cache hit instead of a second paid message.
+"""
+
+import hashlib
+import time
+
+import frappe
+from frappe import _
+from frappe.utils import cint, cstr, now_datetime
+
+from four_whats_net import metrics
+from four_whats_net.utils import bulk_insert
+
+FOUR_WHATS_LOG = "Four Whats Messages"
+HORMUUD_LOG = "Hormuud SMS Messages"
+
+LOG_DOCTYPES = {
+    "SMSHormuud": HORMUUD_LOG,
+    "4Whats.net": FOUR_WHATS_LOG,
+}
+
+# Outbound message key -> log column, per channel
+LOG_FIELDS = {
+    "SMSHormuud": {
+        "phone_number": "phone_number",
+        "message": "messege",
+        "reference_doctype": "doctype_name",
+        "reference_name": "document_name",
+        "notification": "notification",
+    },
+    "4Whats.net": {
+        "phone_number": "phone",
+        "message": "receiver_name",
+        "reference_doctype": "reference_doctype",
+        "reference_name": "reference_name",
+        "notification": "notification",
+    },
+}
+
+IDEMPOTENCY_CACHE_KEY = "four_whats_net:idempotency"
+# A claim only lives as long as a send can take; once sent it is kept for days
+CLAIM_TTL = 10 * 60
+SENT_TTL = 2 * 24 * 60 * 60
+
+# Flush early once this many rows are waiting, or the oldest has waited this long
+FLUSH_SIZE = 500
+FLUSH_INTERVAL = 5
+
+
+class MessageLogBuffer:
+    def __init__(self, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.rows = {}
+        self.updates = {}
+        self.pending = 0
+        self.first_added = None
+
+    def add(self, doctype, row):
+        """Queue a new log row."""
+        self.rows.setdefault(doctype, []).append(row)
+        self.added()
+
+    def update(self, doctype, name, values):
+        """Queue a status change for an existing log row (a retried message)."""
+        self.updates.setdefault(doctype, []).append((name, values))
+        self.added()
+
+    def added(self):
+        self.pending += 1
+        if self.first_added is None:
+            self.first_added = time.monotonic()
+
+        if self.pending >= self.flush_size or time.monotonic() - self.first_added >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        rows, updates = self.rows, self.updates
+        self.rows, self.updates, self.pending, self.first_added = {}, {}, 0, None
+        try:
+            with metrics.timer("log_write", "all"):
+                for doctype, doctype_rows in rows.items():
+                    # The unique idempotency index drops a row a concurrent sender already wrote
+                    bulk_insert(doctype, doctype_rows, ignore_duplicates=True)
+                for doctype, doctype_updates in updates.items():
+                    apply_updates(doctype, doctype_updates)
+                frappe.db.commit()
+        except Exception:
+            frappe.log_error(frappe.get_traceback(), _("Failed to write message log"))
+
+
+def apply_updates(doctype, updates):
+    # Successful retries all get the same values: one UPDATE for the lot,
+    # with the provider message ids (needed to match receipts) set by a CASE
+    sent = {name: values.get("provider_message_id") for name, values in updates if values["status"] == "Sent"}
+    if sent:
+        ids = [(name, provider_id) for name, provider_id in sent.items() if provider_id]
+        case = " ".join("when %s then %s" for _ in ids)
+        frappe.db.sql(
+            f"""update `tab{doctype}`
+            set status = 'Sent', next_retry_at = null, last_error = null, modified = %s,
+                provider_message_id = {f"case name {case} else provider_message_id end" if ids else "provider_message_id"}
+            where name in %s""",
+            (now_datetime(), *[value for pair in ids for value in pair], tuple(sent)),
+        )
+
+    for name, values in updates:
+        if values["status"] != "Sent":
+            frappe.db.set_value(doctype, name, values)
+
+
+def make_log_row(channel, message):
+    """Build the log row for an outbound message that has been through `deliver`."""
+    fields = LOG_FIELDS[channel]
+    row = {column: message.get(key) for key, column in fields.items()}
+    row.update({
+        "idempotency_key": message.get("idempotency_key"),
+        "status": message.status,
+        "retry_count": cint(message.retry_count),
+        "next_retry_at": message.next_retry_at,
+        "last_error": cstr(message.error) if message.error else None,
+        "provider_message_id": message.get("provider_message_id"),
+    })
+    return row
+
+
+def get_log_buffer():
+    """Return the buffer for the current request / job."""
+    if getattr(frappe.local, "message_log_buffer", None) is None:
+        frappe.local.message_log_buffer = MessageLogBuffer()
+    return frappe.local.message_log_buffer
+
+
+def flush_log_buffer():
+    buffer = getattr(frappe.local, "message_log_buffer", None)
+    if buffer:
+        buffer.flush()
+    # Every dispatch ends here; its metrics go to Redis in the same breath
+    metrics.flush_metrics()
+
+
+def make_idempotency_key(notification, doctype, docname, event, recipient, content):
+    """Fixed-size key for one message: same event, recipient and content give the same key."""
+    content_hash = hashlib.sha256(cstr(content).encode()).hexdigest()
+    parts = (notification, doctype, docname, event, recipient, content_hash)
+    return hashlib.sha256("\x1f".join(cstr(part) for part in parts).encode()).hexdigest()
+
+
+def get_idempotency_cache_key(key):
+    return frappe.cache().make_key(f"{IDEMPOTENCY_CACHE_KEY}:{key}")
+
+
+def claim_messages(channel, messages):
+    """Flag messages that were already sent as `duplicate`; return the ones to send.
+
+    Claims are a Redis SET NX per key, so two workers never send the same
+    message at once. Keys the cache no longer knows are checked against the
+    log's index with one query for the whole batch.
+    """
+    keyed = [message for message in messages if message.get("idempotency_key")]
+    if not keyed:
+        return messages
+
+    cache = frappe.cache()
+    pipeline = cache.pipeline()
+    for message in keyed:
+        pipeline.set(get_idempotency_cache_key(message.idempotency_key), 1, nx=True, ex=CLAIM_TTL)
+    claimed = [message for message, ok in zip(keyed, pipeline.execute()) if ok]
+
+    logged = {}
+    if claimed:
+        logged = {
+            row.idempotency_key: row
+            for row in frappe.get_all(
+                LOG_DOCTYPES[channel],
+                filters={"idempotency_key": ["in", [message.idempotency_key for message in claimed]]},
+                fields=["name", "idempotency_key", "status", "retry_count"],
+            )
+        }
+        already_sent = [key for key, row in logged.items() if row.status == "Sent"]
+        # Sent earlier: remember that for the full TTL
+        mark_sent(already_sent)
+
+    claimed_keys = {message.idempotency_key for message in claimed}
+    for message in keyed:
+        row = logged.get(message.idempotency_key)
+        message.duplicate = message.idempotency_key not in claimed_keys or bool(row and row.status == "Sent")
+        if row and not message.duplicate and not message.log_name:
+            # Failed earlier and fired again: this send counts as a retry of the existing row
+            message.log_name, message.retry_count = row.name, cint(row.retry_count) + 1
+
+    return [message for message in messages if not message.get("duplicate")]
+
+
+def settle_claims(messages):
+    """Keep the claims of sent messages, release failed ones so a retry can send them."""
+    mark_sent(message.idempotency_key for message in messages if message.get("idempotency_key") and not message.error)
+
+    failed = [message.idempotency_key for message in messages if message.get("idempotency_key") and message.error]
+    if failed:
+        frappe.cache().delete(*[get_idempotency_cache_key(key) for key in failed])
+
+
+def mark_sent(keys):
+    pipeline = frappe.cache().pipeline()
+    for key in keys:
+        pipeline.set(get_idempotency_cache_key(key), 1, ex=SENT_TTL)
+    pipeline.execute()
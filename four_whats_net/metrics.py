@@ -0,0 +1,166 @@
+"""Send pipeline metrics, aggregated in Redis and exposed for Prometheus.
+
+Each request / job collects its observations in memory (`timer`,
+`observe`, `count`) and writes them with one Redis pipeline when the
+dispatch's message log is flushed. All sites and workers add into one hash
+per site, which `prometheus` renders in the text exposition format:
+
+    four_whats_stage_seconds{stage, provider}   histogram per pipeline stage
+    four_whats_requests_total{provider, status} provider calls by HTTP status
+    four_whats_messages_total{provider, status} messages by delivery outcome
+    four_whats_routed_total{from_channel, to_channel} routing / failover moves
+    four_whats_receipts_total{provider, status} receipts applied / deferred / dropped
+    four_whats_queue_depth{queue}               dispatch / retry / receipt backlogs
+
+Stages are recipients, render, normalize, attachment, rate_limit, http and
+log_write, so "the provider is slow" (http) is told apart from "we are slow"
+(everything else).
+"""
+
+import time
+from contextlib import contextmanager
+
+import frappe
+
+METRICS_KEY = "four_whats_net:metrics"
+
+# Histogram upper bounds, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+HELP = {
+    "four_whats_stage_seconds": ("histogram", "Time spent per send pipeline stage"),
+    "four_whats_requests_total": ("counter", "Provider API calls by HTTP status"),
+    "four_whats_messages_total": ("counter", "Outbound messages by delivery outcome"),
+    "four_whats_routed_total": ("counter", "Messages routed away from their notification's channel"),
+    "four_whats_receipts_total": ("counter", "Delivery receipts applied, deferred until their log row exists, or dropped"),
+    "four_whats_queue_depth": ("gauge", "Messages waiting in each queue"),
+}
+
+
+class Metrics:
+    def __init__(self):
+        self.values = {}
+
+    def add(self, field, value):
+        self.values[field] = self.values.get(field, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        # Every bucket is written (cumulative, as Prometheus expects) so all series share them
+        for bound in BUCKETS:
+            self.add(make_field(f"{name}_bucket", labels, le=bound), 1 if seconds <= bound else 0)
+        self.add(make_field(f"{name}_bucket", labels, le="+Inf"), 1)
+        self.add(make_field(f"{name}_sum", labels), seconds)
+        self.add(make_field(f"{name}_count", labels), 1)
+
+    def count(self, name, value=1, **labels):
+        self.add(make_field(name, labels), value)
+
+    def flush(self):
+        if not self.values:
+            return
+
+        values, self.values = self.values, {}
+        try:
+            key = frappe.cache().make_key(METRICS_KEY)
+            pipeline = frappe.cache().pipeline()
+            for field, value in values.items():
+                pipeline.hincrbyfloat(key, field, value)
+            pipeline.execute()
+        except Exception:
+            # Metrics must never break a send
+            frappe.log_error(frappe.get_traceback(), "Failed to write send metrics")
+
+
+def make_field(name, labels, **extra):
+    labels = {**labels, **extra}
+    if not labels:
+        return name
+    pairs = ",".join(f'{key}="{format_label(value)}"' for key, value in sorted(labels.items()))
+    return f"{name}{{{pairs}}}"
+
+
+def format_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+def get_metrics():
+    """Return the collector for the current request / job."""
+    if getattr(frappe.local, "four_whats_metrics", None) is None:
+        frappe.local.four_whats_metrics = Metrics()
+    return frappe.local.four_whats_metrics
+
+
+def flush_metrics():
+    metrics = getattr(frappe.local, "four_whats_metrics", None)
+    if metrics:
+        metrics.flush()
+
+
+@contextmanager
+def timer(stage, provider):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, provider, time.perf_counter() - start)
+
+
+def observe(stage, provider, seconds):
+    get_metrics().observe("four_whats_stage_seconds", seconds, stage=stage, provider=provider)
+
+
+def count(name, provider, status, value=1):
+    get_metrics().count(name, value, provider=provider, status=status)
+
+
+@frappe.whitelist()
+def prometheus():
+    """Metrics in the Prometheus text format. Scrape with an API key of a System Manager."""
+    from werkzeug.wrappers import Response
+
+    frappe.only_for("System Manager")
+
+    # Raw HGETALL: RedisWrapper.hgetall prefixes the key again and unpickles the
+    # values, but HINCRBYFLOAT wrote them as plain numbers
+    pipeline = frappe.cache().pipeline()
+    pipeline.hgetall(frappe.cache().make_key(METRICS_KEY))
+    (raw,) = pipeline.execute()
+    values = {frappe.safe_decode(field): float(value) for field, value in (raw or {}).items()}
+    for queue, depth in get_queue_depths().items():
+        values[make_field("four_whats_queue_depth", {"queue": queue})] = depth
+
+    return Response(render(values), mimetype="text/plain; version=0.0.4")
+
+
+def render(values):
+    lines = []
+    for name, (metric_type, help_text) in HELP.items():
+        fields = sorted(field for field in values if field.startswith(name))
+        if not fields:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.extend(f"{field} {format_value(values[field])}" for field in fields)
+    return "\n".join(lines) + "\n"
+
+
+def format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+def get_queue_depths():
+    from four_whats_net.dispatch import DISPATCH_JOB
+    from four_whats_net.message_log import LOG_DOCTYPES
+    from four_whats_net.webhooks import get_queue_key
+
+    depths = {"dispatch": frappe.db.count(DISPATCH_JOB, {"status": "Queued"})}
+    for channel, doctype in LOG_DOCTYPES.items():
+        depths[f"retry:{channel}"] = frappe.db.count(doctype, {"status": ["in", ["Retrying", "Queued"]]})
+
+    # Raw LLEN, for the same reason as in `prometheus`
+    pipeline = frappe.cache().pipeline()
+    for channel in LOG_DOCTYPES:
+        pipeline.llen(get_queue_key(channel))
+    for channel, depth in zip(LOG_DOCTYPES, pipeline.execute()):
+        depths[f"receipts:{channel}"] = depth
+    return depths
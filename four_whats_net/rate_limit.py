@@ -0,0 +1,127 @@
+"""Cluster-wide token-bucket rate limiting for provider requests.
+
+Bucket state lives in Redis and is updated by a Lua script, so every web
+and background worker draws from the same bucket and the provider sees at
+most `rate` requests per second (with bursts up to `burst`).
+
+Background workers `acquire`, waiting up to MAX_WAIT for a token. The
+inline send inside a user's document save must not block, so it only
+`try_acquire`s and defers a refused message to the retry scheduler, no
+earlier than the time the refusal names.
+"""
+
+import math
+import time
+
+from frappe.utils import cint, flt
+
+from four_whats_net.utils import RedisScript, get_redis_key
+
+# Takes a token from every bucket in KEYS or, if any of them is short, from
+# none. ARGV holds the requested count, then a rate and a burst per key.
+# Returns {allowed, seconds to wait, redis time, 1-based index of the
+# bucket that refused}
+TOKEN_BUCKET_SCRIPT = """
+local requested = tonumber(ARGV[1])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local levels = {}
+local wait, refused = 0, 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    levels[i] = tokens
+    if tokens < requested and (requested - tokens) / rate > wait then
+        wait, refused = (requested - tokens) / rate, i
+    end
+end
+
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local tokens = levels[i]
+    if wait == 0 then
+        tokens = tokens - requested
+    end
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+end
+if wait > 0 then
+    return {0, tostring(wait), tostring(now), refused}
+end
+return {1, '0', tostring(now), 0}
+"""
+
+# Longest a background sender blocks waiting for a token before giving up on the message
+MAX_WAIT = 60
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, key, retry_at):
+        super().__init__(f"Rate limit for {key} exceeded, retry at {retry_at:.3f}")
+        self.retry_at = retry_at
+
+
+class TokenBucket:
+    """One rate limit: `rate` requests per second, in bursts of up to `burst`."""
+
+    def __init__(self, name, rate, burst=None, shared=False):
+        self.name = name
+        self.key = get_redis_key(f"four_whats_net:rate_limit:{name}", shared=shared)
+        self.rate = flt(rate)
+        self.burst = cint(burst) or max(math.ceil(self.rate), 1)
+
+
+class RateLimiter:
+    """The buckets a request has to pass, shared by every worker through Redis.
+
+    A request takes a token from each bucket or from none, so a bucket that
+    refuses never leaves the others short for nothing. Its script is a
+    `RedisScript`: build it on a thread with a frappe site context, then
+    `try_acquire` / `acquire` from any thread.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.script = RedisScript(TOKEN_BUCKET_SCRIPT) if buckets else None
+
+    def try_acquire(self, tokens=1):
+        """Take `tokens` from every bucket if all have them. Raise RateLimitExceeded otherwise."""
+        if not self.buckets:
+            return
+        args = [tokens]
+        for bucket in self.buckets:
+            args += [bucket.rate, bucket.burst]
+        allowed, wait, now, refused = self.script.call([bucket.key for bucket in self.buckets], args)
+        if not allowed:
+            raise RateLimitExceeded(self.buckets[refused - 1].name, now + wait)
+
+    def acquire(self, tokens=1, timeout=MAX_WAIT):
+        """Block until `tokens` are available; raise RateLimitExceeded past `timeout` seconds."""
+        deadline = time.time() + timeout
+        while True:
+            try:
+                return self.try_acquire(tokens)
+            except RateLimitExceeded as e:
+                if e.retry_at > deadline:
+                    raise
+                time.sleep(max(e.retry_at - time.time(), 0.001))
+
+
+def get_rate_limiter(channel, settings):
+    """Return the limiter a request over `channel` has to pass, per provider and per sender."""
+    buckets = []
+    if flt(settings.get("rate_limit")):
+        buckets.append(TokenBucket(channel, settings.rate_limit, settings.get("rate_limit_burst")))
+
+    # A 4Whats instance can be shared by several sites, so its bucket is not site-scoped
+    if channel == "4Whats.net" and flt(settings.get("instance_rate_limit")):
+        buckets.append(
+            TokenBucket(f"{channel}:instance:{settings.instance_id}", settings.instance_rate_limit, shared=True)
+        )
+    return RateLimiter(buckets)
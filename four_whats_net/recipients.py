@@ -0,0 +1,118 @@
+"""Cached recipient phone lists for notifications.
+
+Frappe resolves a "by role" recipient with one query for the role's users
+plus one per user, and the document owner with one more - on every
+document event. Here each such source (a role, a user) is resolved once
+into its (number, normalized number) pairs and kept in Redis, so a
+notification reads all of its role and owner recipients in one round
+trip. The lists do not depend on the notification, so every notification
+naming the same role shares one entry.
+
+Entries are dropped by the User, Contact and Has Role doc_events, which
+are the only places their numbers come from; the TTL is just a backstop.
+Recipients taken from a field of the document differ per document and are
+still rendered and normalized on every send.
+"""
+
+import json
+
+import frappe
+
+from four_whats_net.phone import normalize_many
+
+RECIPIENTS_KEY = "four_whats_net:recipients"
+RECIPIENTS_TTL = 24 * 60 * 60
+
+
+def get_recipient_numbers(notification, doc, context):
+    """Return ([(number, normalized number)] from cached sources, [raw document field values])."""
+    sources = []
+    field_values = []
+    for recipient in notification.recipients:
+        if recipient.condition and not frappe.safe_eval(recipient.condition, None, context):
+            continue
+        if recipient.receiver_by_document_field == "owner":
+            sources.append(("User", doc.get("owner")))
+        elif recipient.receiver_by_document_field and doc.get(recipient.receiver_by_document_field):
+            field_values.append(doc.get(recipient.receiver_by_document_field))
+        if recipient.receiver_by_role:
+            sources.append(("Role", recipient.receiver_by_role))
+
+    pairs = []
+    for source_pairs in get_sources(sources):
+        pairs += source_pairs
+    return pairs, field_values
+
+
+def get_sources(sources):
+    """The cached pairs of every source, in order, resolving and storing the missing ones."""
+    if not sources:
+        return []
+
+    cache = frappe.cache()
+    pipeline = cache.pipeline()
+    for kind, name in sources:
+        pipeline.get(get_recipients_key(kind, name))
+    cached = pipeline.execute()
+
+    result = []
+    pipeline = cache.pipeline()
+    for (kind, name), value in zip(sources, cached):
+        if value is None:
+            pairs = resolve_source(kind, name)
+            pipeline.set(get_recipients_key(kind, name), json.dumps(pairs), ex=RECIPIENTS_TTL)
+        else:
+            pairs = json.loads(value)
+        result.append(pairs)
+    pipeline.execute()
+    return result
+
+
+def resolve_source(kind, name):
+    if not name:
+        return []
+    if kind == "User":
+        numbers = frappe.get_all("User", filters={"name": name, "enabled": 1}, pluck="mobile_no")
+    else:
+        # One join instead of frappe's query per user of the role
+        numbers = frappe.db.sql_list(
+            """select user.mobile_no from `tabUser` user
+            join `tabHas Role` has_role on has_role.parent = user.name and has_role.parenttype = 'User'
+            where has_role.role = %s and user.enabled = 1
+            order by user.name""",
+            name,
+        )
+    numbers = [number for number in numbers if number]
+    return [list(pair) for pair in zip(numbers, normalize_many(numbers))]
+
+
+def invalidate_user_recipients(doc, method=None):
+    """doc_event for User: its own number and every role it has (or just lost)."""
+    roles = {row.role for row in doc.get("roles") or []}
+    before = doc.get_doc_before_save() if method != "on_trash" else None
+    if before:
+        roles |= {row.role for row in before.get("roles") or []}
+    invalidate([("User", doc.name)] + [("Role", role) for role in roles])
+
+
+def invalidate_contact_recipients(doc, method=None):
+    """doc_event for Contact: a contact's numbers are synced to the user it belongs to."""
+    if doc.get("user"):
+        invalidate([("User", doc.user)] + [("Role", role) for role in frappe.get_roles(doc.user)])
+
+
+def invalidate_role_recipients(doc, method=None):
+    """doc_event for Has Role rows saved on their own rather than with their user."""
+    if doc.get("parenttype") == "User":
+        invalidate([("Role", doc.role)])
+
+
+def invalidate(sources):
+    cache = frappe.cache()
+    # After commit, or a send in between could cache the old numbers again
+    keys = [get_recipients_key(kind, name) for kind, name in sources]
+    frappe.db.after_commit.add(lambda: cache.delete(*keys))
+
+
+def get_recipients_key(kind, name):
+    return frappe.cache().make_key(f"{RECIPIENTS_KEY}:{kind}:{name}")
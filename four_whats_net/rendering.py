@@ -0,0 +1,47 @@
+"""Compiled Jinja templates for notification messages and recipients.
+
+Templates are compiled once per Notification (or Notification Broadcast)
+version, i.e. its `modified` timestamp, and kept per process; a new version
+simply replaces the old entry, so editing one never serves a stale template.
+"""
+
+import frappe
+from frappe import _
+from frappe.utils.jinja import get_jenv
+
+# (site, doctype, name) -> {"modified": ..., "templates": {source: jinja2.Template}}
+_compiled = {}
+
+
+def get_template(notification, source):
+    key = (frappe.local.site, notification.doctype, notification.name)
+    modified = str(notification.modified)
+    entry = _compiled.get(key)
+    if not entry or entry["modified"] != modified:
+        entry = _compiled[key] = {"modified": modified, "templates": {}}
+
+    template = entry["templates"].get(source)
+    if template is None:
+        # Same guard frappe.render_template applies before rendering
+        if ".__" in source:
+            frappe.throw(_("Illegal template"))
+        template = entry["templates"][source] = get_jenv().from_string(source)
+    return template
+
+
+def render_message(notification, context):
+    """Render the notification's message body; call once per document."""
+    return get_template(notification, notification.message).render(context)
+
+
+def render_recipients(notification, recipients, context):
+    """Render the recipient templates, preserving order.
+
+    Plain values (no Jinja markup) are passed through untouched; each
+    distinct template renders once, from the compiled cache.
+    """
+    rendered = {}
+    for recipient in recipients:
+        if "{" in recipient and recipient not in rendered:
+            rendered[recipient] = get_template(notification, recipient).render(context)
+    return [rendered.get(recipient, recipient) for recipient in recipients]
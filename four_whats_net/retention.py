@@ -0,0 +1,195 @@
+"""Retention for the Four Whats Messages / Hormuud SMS Messages logs.
+
+Every completed day is rolled up into Message Daily Summary: one row per
+date, channel, status and reference doctype with message, delivered and
+read counts. Dashboards and `get_message_stats` read only that table, so
+they cost the same however much history there is.
+
+Once a day is older than the provider's *Keep Messages For (Days)* its
+detailed rows are appended to a gzipped JSON lines file per day under
+private/files/message_log_archive/<log>/ and deleted PURGE_CHUNK_SIZE rows
+at a time, each chunk in its own short transaction. A day is always rolled
+up before its first row is deleted, and never recomputed after that.
+"""
+
+import gzip
+import json
+import os
+
+import frappe
+from frappe import _
+from frappe.utils import add_days, cint, getdate, now_datetime, nowdate
+
+from four_whats_net.delivery import CHANNEL_SETTINGS
+from four_whats_net.message_log import LOG_DOCTYPES, LOG_FIELDS
+from four_whats_net.settings import get_settings
+
+SUMMARY = "Message Daily Summary"
+
+PURGE_CHUNK_SIZE = 1000
+ARCHIVE_FOLDER = "message_log_archive"
+
+# Days still open to late receipts and retries; recomputed on every run
+ROLLUP_DAYS = 2
+
+LOCK_TTL = 60 * 60
+
+
+def run_retention():
+    """Scheduler hook (daily): roll up recent days, then archive and purge expired ones."""
+    cache = frappe.cache()
+    lock_key = cache.make_key("four_whats_net:retention")
+    if not cache.set(lock_key, 1, nx=True, ex=LOCK_TTL):
+        return
+
+    try:
+        for channel in LOG_DOCTYPES:
+            for days_ago in range(ROLLUP_DAYS, 0, -1):
+                rollup_day(channel, add_days(nowdate(), -days_ago))
+            frappe.db.commit()
+            purge_expired(channel)
+    finally:
+        cache.delete(lock_key)
+
+
+def rollup_day(channel, day):
+    """(Re)compute the summary rows of one channel for one day."""
+    doctype = LOG_DOCTYPES[channel]
+    reference_column = LOG_FIELDS[channel]["reference_doctype"]
+    start, end = get_day_range(day)
+
+    rows = frappe.db.sql(
+        f"""select status, `{reference_column}` as reference_doctype, count(*) as message_count,
+            sum(receipt_status in ('Delivered', 'Read')) as delivered_count,
+            sum(receipt_status = 'Read') as read_count
+        from `tab{doctype}`
+        where creation >= %(start)s and creation < %(end)s
+        group by status, `{reference_column}`""",
+        {"start": start, "end": end},
+        as_dict=True,
+    )
+
+    frappe.db.delete(SUMMARY, {"summary_date": day, "channel": channel})
+    if not rows:
+        return
+
+    now, user = now_datetime(), frappe.session.user
+    values = []
+    for row in rows:
+        key = "|".join((str(day), channel, row.status or "", row.reference_doctype or ""))
+        values.append((
+            key, now, now, user, user, 0, key, day, channel, row.status, row.reference_doctype,
+            cint(row.message_count), cint(row.delivered_count), cint(row.read_count),
+        ))
+    frappe.db.bulk_insert(
+        SUMMARY,
+        [
+            "name", "creation", "modified", "owner", "modified_by", "docstatus", "summary_key", "summary_date",
+            "channel", "status", "reference_doctype", "message_count", "delivered_count", "read_count",
+        ],
+        values,
+    )
+
+
+@frappe.whitelist()
+def backfill_rollup(channel=None):
+    """Roll up every day already in the logs, e.g. right after installing retention."""
+    frappe.only_for("System Manager")
+    frappe.enqueue("four_whats_net.retention.run_backfill", queue="long", timeout=6 * 60 * 60, channel=channel)
+
+
+def run_backfill(channel=None):
+    for log_channel in [channel] if channel else LOG_DOCTYPES:
+        day = get_oldest_day(LOG_DOCTYPES[log_channel])
+        while day and day < getdate(nowdate()):
+            rollup_day(log_channel, day)
+            frappe.db.commit()
+            day = getdate(add_days(day, 1))
+
+
+def purge_expired(channel):
+    settings = get_settings(CHANNEL_SETTINGS[channel])
+    retention_days = cint(settings.get("log_retention_days"))
+    if retention_days <= 0:
+        return
+
+    # Days still being re-rolled up must keep their rows
+    retention_days = max(retention_days, ROLLUP_DAYS + 1)
+    doctype = LOG_DOCTYPES[channel]
+    cutoff = getdate(add_days(nowdate(), -retention_days))
+    day = get_oldest_day(doctype)
+    while day and day < cutoff:
+        if not frappe.db.exists(SUMMARY, {"summary_date": day, "channel": channel}):
+            # Never rolled up (e.g. history from before retention): do it while the day is whole
+            rollup_day(channel, day)
+            frappe.db.commit()
+        purge_day(doctype, day, archive=cint(settings.get("archive_purged_logs")))
+        day = get_oldest_day(doctype)
+
+
+def purge_day(doctype, day, archive=True):
+    """Archive and delete one day of a log, PURGE_CHUNK_SIZE rows per transaction."""
+    start, end = get_day_range(day)
+    path = get_archive_path(doctype, day) if archive else None
+
+    while True:
+        rows = frappe.db.sql(
+            f"""select * from `tab{doctype}`
+            where creation >= %(start)s and creation < %(end)s
+            order by creation, name
+            limit %(limit)s""",
+            {"start": start, "end": end, "limit": PURGE_CHUNK_SIZE},
+            as_dict=True,
+        )
+        if not rows:
+            return
+
+        if path:
+            # Each chunk is its own gzip member; gzip readers see one continuous file
+            with gzip.open(path, "at", encoding="utf-8") as f:
+                for row in rows:
+                    f.write(json.dumps(row, default=str) + "\n")
+
+        frappe.db.sql(f"delete from `tab{doctype}` where name in %(names)s", {"names": tuple(row.name for row in rows)})
+        frappe.db.commit()
+
+
+def get_archive_path(doctype, day):
+    folder = frappe.get_site_path("private", "files", ARCHIVE_FOLDER, frappe.scrub(doctype))
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f"{day}.jsonl.gz")
+
+
+def get_oldest_day(doctype):
+    oldest = frappe.db.sql(f"select min(creation) from `tab{doctype}`")[0][0]
+    return getdate(oldest) if oldest else None
+
+
+def get_day_range(day):
+    day = getdate(day)
+    return f"{day} 00:00:00", f"{add_days(day, 1)} 00:00:00"
+
+
+@frappe.whitelist()
+def get_message_stats(from_date, to_date, channel=None, group_by="summary_date"):
+    """Message counts per day (or status / channel / reference doctype) from the rollup."""
+    frappe.has_permission(SUMMARY, throw=True)
+    if group_by not in ("summary_date", "channel", "status", "reference_doctype"):
+        frappe.throw(_("Cannot group by {0}").format(group_by))
+
+    filters = {"summary_date": ["between", [from_date, to_date]]}
+    if channel:
+        filters["channel"] = channel
+
+    return frappe.get_all(
+        SUMMARY,
+        filters=filters,
+        fields=[
+            f"{group_by} as `key`",
+            "sum(message_count) as message_count",
+            "sum(delivered_count) as delivered_count",
+            "sum(read_count) as read_count",
+        ],
+        group_by=group_by,
+        order_by=f"{group_by} asc",
+    )
@@ -0,0 +1,100 @@
+"""Retry scheduler and dead-letter re-drive for the message logs.
+
+A message whose request failed with a retryable error (outage, timeout,
+throttling) is logged as Retrying with a `next_retry_at` from exponential
+backoff with jitter. Every minute the scheduler sends the due rows again
+through `deliver`, which updates the same log row. After MAX_RETRIES it
+lands in the dead-letter list (status Dead), where it stays until someone
+re-drives it from the log's list view.
+"""
+
+import frappe
+from frappe import _
+from frappe.utils import cint, now_datetime
+
+from four_whats_net.attachments import clear_media_memo, get_notification_media
+from four_whats_net.delivery import deliver
+from four_whats_net.message_log import LOG_DOCTYPES, LOG_FIELDS, flush_log_buffer
+
+BATCH_SIZE = 200
+
+# A run that takes longer than this is assumed dead and another may start
+LOCK_TTL = 5 * 60
+
+
+def process_retries(batch_size=BATCH_SIZE):
+    """Scheduler hook: resend the log rows whose retry is due, channel by channel."""
+    cache = frappe.cache()
+    for channel, doctype in LOG_DOCTYPES.items():
+        lock_key = cache.make_key(f"four_whats_net:retry:{doctype}")
+        # One retry run per log at a time; the next minute's run picks up the rest
+        if not cache.set(lock_key, 1, nx=True, ex=LOCK_TTL):
+            continue
+
+        try:
+            retry_due(channel, doctype, batch_size)
+        except Exception:
+            frappe.db.rollback()
+            frappe.log_error(title=_("Failed to retry {0}").format(doctype), message=frappe.get_traceback())
+        finally:
+            cache.delete(lock_key)
+
+
+def retry_due(channel, doctype, batch_size):
+    fields = LOG_FIELDS[channel]
+    rows = frappe.get_all(
+        doctype,
+        filters={"status": ["in", ["Retrying", "Queued"]], "next_retry_at": ["<=", now_datetime()]},
+        fields=["name", "idempotency_key", "retry_count", *fields.values()],
+        order_by="next_retry_at asc",
+        limit=batch_size,
+    )
+    if not rows:
+        return
+
+    messages = []
+    for row in rows:
+        message = frappe._dict({key: row.get(column) for key, column in fields.items()})
+        message.update(
+            log_name=row.name,
+            idempotency_key=row.idempotency_key,
+            # Counts this attempt, so the backoff keeps growing if it fails again
+            retry_count=cint(row.retry_count) + 1,
+        )
+        if channel == "4Whats.net":
+            message.media = get_notification_media(
+                message.notification, message.reference_doctype, message.reference_name
+            )
+        messages.append(message)
+
+    try:
+        deliver(channel, messages)
+    finally:
+        flush_log_buffer()
+        clear_media_memo()
+    frappe.db.commit()
+
+
+@frappe.whitelist()
+def redrive(doctype, names=None):
+    """Queue dead-lettered (Dead or Failed) rows of a message log for another round of retries.
+
+    Without `names`, every dead-lettered row of the log is re-driven.
+    """
+    if doctype not in LOG_DOCTYPES.values():
+        frappe.throw(_("{0} is not a message log").format(doctype))
+    frappe.has_permission(doctype, "write", throw=True)
+
+    filters = {"status": ["in", ["Dead", "Failed"]]}
+    if names:
+        filters["name"] = ["in", frappe.parse_json(names) if isinstance(names, str) else names]
+
+    names = frappe.get_all(doctype, filters=filters, pluck="name")
+    if names:
+        frappe.db.sql(
+            f"""update `tab{doctype}`
+            set status = 'Queued', retry_count = 0, next_retry_at = %(now)s, modified = %(now)s
+            where name in %(names)s""",
+            {"now": now_datetime(), "names": tuple(names)},
+        )
+    return len(names)
@@ -0,0 +1,112 @@
+"""Per-recipient channel routing with failover.
+
+With Notification Routing Settings enabled, every outbound message is sent
+over the cheapest channel that
+
+- has a route for the recipient's country calling code (or a catch-all
+  route with no country code),
+- can carry the message (Hormuud only reaches Somali mobiles, 4Whats.net
+  needs the PDF, and neither takes a number suppressed on it), and
+- is healthy: its circuit breaker is not open, and it is within its error
+  budget and latency budget over the last few minutes, as recorded by
+  `deliver`.
+
+The notification's own channel is always a candidate, so a WhatsApp
+notification to a 252 number moves to Hormuud SMS while 4Whats is failing
+and comes back once it recovers. When no candidate is healthy the message
+stays on its own channel and the retry scheduler takes over from there.
+"""
+
+from frappe.utils import cint, flt
+
+from four_whats_net.circuit import get_open_until
+from four_whats_net.delivery import deliver
+from four_whats_net.health import get_health
+from four_whats_net.metrics import get_metrics
+from four_whats_net.phone import get_country_code, is_somali_mobile
+from four_whats_net.settings import get_settings
+from four_whats_net.suppression import get_suppression
+
+ROUTING_SETTINGS = "Notification Routing Settings"
+
+
+def route_and_deliver(channel, messages, wait=True):
+    """Deliver `messages` of a `channel` notification, each over its routed channel (see `deliver` for `wait`)."""
+    for routed_channel, routed in route_messages(channel, messages).items():
+        deliver(routed_channel, routed, wait)
+    return messages
+
+
+def route_messages(channel, messages):
+    """Group messages by the channel they should go out on: {channel: [messages]}."""
+    settings = get_settings(ROUTING_SETTINGS)
+    if not cint(settings.enabled) or not settings.routes:
+        return {channel: messages} if messages else {}
+
+    routes = get_routes(settings)
+    healthy = {}
+    by_channel = {}
+    for message in messages:
+        routed_channel = channel
+        # A retry belongs to its log row's channel
+        if not message.get("log_name"):
+            routed_channel = pick_channel(settings, routes, channel, message, healthy)
+        if routed_channel != channel:
+            message.routed_from = channel
+            get_metrics().count("four_whats_routed_total", from_channel=channel, to_channel=routed_channel)
+        by_channel.setdefault(routed_channel, []).append(message)
+    return by_channel
+
+
+def pick_channel(settings, routes, channel, message, healthy):
+    country_code = get_country_code(message.phone_number)
+    costs = routes.get(country_code) or routes.get("")
+    if not costs:
+        return channel
+
+    candidates = dict(costs)
+    # The notification's own channel costs nothing extra to stay on
+    candidates.setdefault(channel, 0)
+
+    usable = []
+    for candidate, cost in candidates.items():
+        if not can_carry(candidate, message):
+            continue
+        if candidate not in healthy:
+            healthy[candidate] = is_healthy(settings, candidate)
+        if healthy[candidate]:
+            usable.append((cost, candidate != channel, candidate))
+
+    return min(usable)[2] if usable else channel
+
+
+def get_routes(settings):
+    """{country code: {channel: cost}}; "" holds the routes for any country."""
+    routes = {}
+    for route in settings.routes:
+        country_code = (route.get("country_code") or "").translate(str.maketrans("", "", "+- "))
+        routes.setdefault(country_code, {})[route.get("channel")] = flt(route.get("cost"))
+    return routes
+
+
+def can_carry(channel, message):
+    if get_suppression(channel, message.phone_number):
+        return False
+    if channel == "SMSHormuud":
+        return is_somali_mobile(message.phone_number)
+    if channel == "4Whats.net":
+        return bool(message.get("media"))
+    return False
+
+
+def is_healthy(settings, channel):
+    if get_open_until(channel):
+        return False
+    health = get_health(channel, cint(settings.health_window) or 5)
+    if health.requests < (cint(settings.min_requests) or 1):
+        # Too little traffic to judge; assume it works
+        return True
+    if health.error_rate * 100 > flt(settings.error_budget):
+        return False
+    latency_budget = flt(settings.latency_budget)
+    return not latency_budget or health.latency <= latency_budget
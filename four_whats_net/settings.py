@@ -0,0 +1,85 @@
+"""Per-process snapshots of the provider configuration doctypes.
+
+`get_settings` builds a read-only snapshot of a configuration (passwords
+decrypted) the first time a process needs it and serves it from memory
+after that, so the send path never reads the configuration from the
+database. Saving a configuration bumps its version stamp in Redis once the
+transaction commits; every process compares its snapshot with the stamp at
+most once per VERSION_CHECK_INTERVAL and rebuilds when they differ.
+"""
+
+import time
+
+import frappe
+
+VERSION_KEY = "four_whats_net:settings_version"
+
+# Seconds a process trusts its snapshot before looking at the version stamp again
+VERSION_CHECK_INTERVAL = 1
+
+# (site, doctype) -> {"version": ..., "checked_at": ..., "settings": Settings}
+_snapshots = {}
+
+
+class Settings(frappe._dict):
+    """A configuration snapshot: read like the document, never written to."""
+
+    def __setitem__(self, key, value):
+        raise TypeError(f"{self.get('doctype')} settings are read-only; save the document instead")
+
+    __setattr__ = __setitem__
+    __delitem__ = __setitem__
+
+    def update(self, *args, **kwargs):
+        raise TypeError(f"{self.get('doctype')} settings are read-only; save the document instead")
+
+
+def get_settings(doctype):
+    """Return the current snapshot of a provider configuration (a Single doctype)."""
+    key = (frappe.local.site, doctype)
+    entry = _snapshots.get(key)
+    now = time.monotonic()
+    if entry and now - entry["checked_at"] < VERSION_CHECK_INTERVAL:
+        return entry["settings"]
+
+    version = get_version(doctype)
+    if entry and entry["version"] == version:
+        entry["checked_at"] = now
+        return entry["settings"]
+
+    entry = _snapshots[key] = {"version": version, "checked_at": now, "settings": build_settings(doctype)}
+    return entry["settings"]
+
+
+def build_settings(doctype):
+    doc = frappe.get_doc(doctype)
+    values = doc.as_dict(no_default_fields=True)
+    for df in doc.meta.get("fields", {"fieldtype": "Password"}):
+        values[df.fieldname] = doc.get_password(df.fieldname, raise_exception=False)
+    return Settings(values)
+
+
+def invalidate_settings(doctype):
+    """Called from the configuration's on_update: every process rebuilds its snapshot."""
+    drop_snapshot(doctype)
+    # Bumped only after commit, or another worker could rebuild from the old row under the new version
+    frappe.db.after_commit.add(lambda: bump_version(doctype))
+
+
+def bump_version(doctype):
+    drop_snapshot(doctype)
+    frappe.cache().incr(get_version_key(doctype))
+
+
+def drop_snapshot(doctype):
+    """Make this process rebuild its snapshot of `doctype` on the next read."""
+    _snapshots.pop((frappe.local.site, doctype), None)
+
+
+def get_version(doctype):
+    version = frappe.cache().get(get_version_key(doctype))
+    return frappe.safe_decode(version) if version is not None else None
+
+
+def get_version_key(doctype):
+    return frappe.cache().make_key(f"{VERSION_KEY}:{doctype}")
@@ -0,0 +1,147 @@
+"""Numbers we must not (or need not) message: opt-outs, bounces, non-WhatsApp numbers.
+
+The Message Suppression list is held in every process as a dict per
+channel, so `get_suppression` is a hash lookup and `deliver` drops a
+suppressed message before it costs an HTTP call and a paid message.
+
+Once its transaction commits, each change to the list is numbered and
+stored in a Redis sorted set by one Lua script, so no process ever sees
+them out of order or with gaps. A process looks at the change counter at
+most once per CHECK_INTERVAL and replays only the changes it has not seen;
+it reloads the whole list only at start-up or when it has fallen further
+behind than the changes Redis keeps.
+
+A number whose last few messages all came back "Undelivered" is added
+to the list for their channel as Bounced, until `expires_on`: one failed
+receipt may just be a phone that stayed off until the message expired.
+Expired entries are removed daily.
+"""
+
+import json
+import time
+
+import frappe
+from frappe.utils import today
+
+from four_whats_net.phone import normalize
+from four_whats_net.utils import RedisScript, get_redis_key
+
+SUPPRESSION = "Message Suppression"
+
+VERSION_KEY = "four_whats_net:suppression_version"
+CHANGES_KEY = "four_whats_net:suppression_changes"
+
+# Seconds a process trusts its copy before looking at the version counter again
+CHECK_INTERVAL = 1
+
+# Changes kept for processes catching up; one further behind reloads the list
+MAX_CHANGES = 10000
+
+# Numbers the change and stores it atomically, trimming the oldest
+PUBLISH_SCRIPT = """
+local version = redis.call('INCR', KEYS[1])
+local change = cjson.encode({version, ARGV[1], ARGV[2], ARGV[3], ARGV[4]})
+redis.call('ZADD', KEYS[2], version, change)
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -tonumber(ARGV[5]) - 1)
+return version
+"""
+
+class MessageSuppressed(Exception):
+    def __init__(self, phone_number, channel, reason):
+        super().__init__(f"{phone_number} is on the suppression list for {channel} ({reason})")
+        self.reason = reason
+
+
+# site -> {"version": ..., "checked_at": ..., "numbers": {channel: {phone_number: reason}}}
+_lists = {}
+
+
+def get_suppression(channel, phone_number):
+    """Return the reason `phone_number` must not get messages on `channel`, or None."""
+    numbers = get_suppressed_numbers()
+    return numbers.get("All", {}).get(phone_number) or numbers.get(channel, {}).get(phone_number)
+
+
+def get_suppressed_numbers():
+    site = frappe.local.site
+    entry = _lists.get(site)
+    now = time.monotonic()
+    if entry and now - entry["checked_at"] < CHECK_INTERVAL:
+        return entry["numbers"]
+
+    version = get_version()
+    if not entry:
+        entry = _lists[site] = {"version": version, "numbers": load_numbers()}
+    elif version != entry["version"] and (version < entry["version"] or not replay_changes(entry)):
+        # Redis was flushed, or we fell too far behind
+        entry["version"], entry["numbers"] = version, load_numbers()
+    entry["checked_at"] = now
+    return entry["numbers"]
+
+
+def load_numbers():
+    numbers = {}
+    for row in frappe.get_all(SUPPRESSION, fields=["phone_number", "channel", "reason"]):
+        numbers.setdefault(row.channel, {})[row.phone_number] = row.reason
+    return numbers
+
+
+def replay_changes(entry):
+    """Apply the changes after `entry`'s version; False if some are gone and it must reload."""
+    changes = frappe.cache().zrangebyscore(get_redis_key(CHANGES_KEY), entry["version"] + 1, "+inf")
+    for change in changes:
+        version, action, channel, phone_number, reason = json.loads(change)
+        if version != entry["version"] + 1:
+            # Trimmed away before we caught up
+            return False
+        if action == "add":
+            entry["numbers"].setdefault(channel, {})[phone_number] = reason
+        else:
+            entry["numbers"].get(channel, {}).pop(phone_number, None)
+        entry["version"] = version
+    return True
+
+
+def publish_change(action, channel, phone_number, reason=None):
+    """Hand a committed change to every process."""
+    RedisScript(PUBLISH_SCRIPT).call(
+        [get_redis_key(VERSION_KEY), get_redis_key(CHANGES_KEY)],
+        [action, channel, phone_number, reason or "", MAX_CHANGES],
+    )
+
+
+def add_suppression(
+    phone_number, channel="All", reason="Bounced", provider_message_id=None, notes=None, expires_on=None
+):
+    """Put a number on the list unless it already is; returns whether it was added."""
+    phone_number = normalize(phone_number)
+    if not phone_number or frappe.db.exists(SUPPRESSION, get_suppression_key(channel, phone_number)):
+        return False
+
+    frappe.get_doc({
+        "doctype": SUPPRESSION,
+        "phone_number": phone_number,
+        "channel": channel,
+        "reason": reason,
+        "provider_message_id": provider_message_id,
+        "notes": notes,
+        "expires_on": expires_on,
+    }).insert(ignore_permissions=True)
+    return True
+
+
+def remove_expired_suppressions():
+    """Daily scheduler hook: take numbers off the list once their suppression expires."""
+    for name in frappe.get_all(SUPPRESSION, filters={"expires_on": ["<=", today()]}, pluck="name"):
+        # One at a time, so on_trash hands each removal to every process
+        frappe.delete_doc(SUPPRESSION, name, ignore_permissions=True)
+    frappe.db.commit()
+
+
+def get_suppression_key(channel, phone_number):
+    return f"{channel}:{phone_number}"
+
+
+def get_version():
+    version = frappe.cache().get(get_redis_key(VERSION_KEY))
+    return int(version) if version is not None else 0
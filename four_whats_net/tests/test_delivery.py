@@ -0,0 +1,44 @@
+import time
+
+import requests
+
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_to_date, now_datetime
+
+from four_whats_net.delivery import MAX_RETRIES, get_failure_state
+from four_whats_net.rate_limit import RateLimitExceeded
+from four_whats_net.suppression import MessageSuppressed
+
+
+def http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(f"{status_code} error", response=response)
+
+
+class TestFailureState(FrappeTestCase):
+    def test_rejected_requests_fail_for_good(self):
+        self.assertEqual(get_failure_state(http_error(400), 0), ("Failed", None))
+        self.assertEqual(get_failure_state(ValueError("No PDF attachment"), 0), ("Failed", None))
+
+    def test_suppressed_numbers_are_not_retried(self):
+        error = MessageSuppressed("252615123456", "All", "Opted Out")
+        self.assertEqual(get_failure_state(error, 0), ("Suppressed", None))
+
+    def test_outages_are_retried_with_backoff(self):
+        for error in (requests.ConnectionError(), requests.Timeout(), http_error(429), http_error(503)):
+            before = now_datetime()
+            status, next_retry_at = get_failure_state(error, 2)
+            self.assertEqual(status, "Retrying")
+            # 60 * 2^2 seconds with equal jitter: between half and all of it
+            self.assertGreaterEqual(next_retry_at, add_to_date(before, seconds=120))
+            self.assertLessEqual(next_retry_at, add_to_date(now_datetime(), seconds=240))
+
+    def test_retries_run_out(self):
+        self.assertEqual(get_failure_state(requests.ConnectionError(), MAX_RETRIES), ("Dead", None))
+
+    def test_rate_limit_retry_time_is_respected(self):
+        before = now_datetime()
+        status, next_retry_at = get_failure_state(RateLimitExceeded("SMSHormuud", time.time() + 3600), 0)
+        self.assertEqual(status, "Retrying")
+        self.assertGreaterEqual(next_retry_at, add_to_date(before, seconds=3590))
@@ -0,0 +1,39 @@
+import unittest
+
+from four_whats_net.phone import get_country_code, is_somali_mobile, normalize, normalize_many
+
+
+class TestPhone(unittest.TestCase):
+    def test_longest_country_code_wins(self):
+        self.assertEqual(get_country_code("12685551234"), "1268")  # Antigua, not NANP
+        self.assertEqual(get_country_code("15551234567"), "1")
+        self.assertEqual(get_country_code("252615123456"), "252")  # Somalia, not a shorter code
+        self.assertEqual(get_country_code("254712345678"), "254")
+        self.assertEqual(get_country_code("97455123456"), "974")
+        self.assertIsNone(get_country_code("999123"))
+
+    def test_normalize(self):
+        self.assertEqual(normalize("+252 61 5123456"), "252615123456")
+        self.assertEqual(normalize("00252615123456"), "252615123456")
+        # Local Somali number
+        self.assertEqual(normalize("0615123456"), "252615123456")
+        self.assertEqual(normalize("+974 5512 3456"), "97455123456")
+        self.assertEqual(normalize("+1-268-555-1234"), "12685551234")
+
+    def test_unusable_numbers(self):
+        self.assertIsNone(normalize(None))
+        self.assertIsNone(normalize(""))
+        self.assertIsNone(normalize("123"))
+
+    def test_normalize_many_keeps_input_order(self):
+        numbers = ["0615123456", "+974 5512 3456", "123", "+1-268-555-1234", "0615123456"]
+        self.assertEqual(
+            normalize_many(numbers),
+            ["252615123456", "97455123456", None, "12685551234", "252615123456"],
+        )
+        self.assertEqual(normalize_many(numbers), [normalize(number) for number in numbers])
+
+    def test_is_somali_mobile(self):
+        self.assertTrue(is_somali_mobile("252615123456"))
+        self.assertFalse(is_somali_mobile("25261512345"))
+        self.assertFalse(is_somali_mobile("97455123456"))
@@ -0,0 +1,29 @@
+from frappe.tests.utils import FrappeTestCase
+
+from four_whats_net.webhooks import get_events, parse_receipt
+
+
+class TestReceipts(FrappeTestCase):
+    def test_parse_hormuud_receipt(self):
+        self.assertEqual(parse_receipt({"MessageID": 123, "Status": " DELIVRD "}), ["123", "Delivered"])
+        self.assertEqual(parse_receipt({"MessageID": 124, "Status": "undeliv"}), ["124", "Undelivered"])
+
+    def test_parse_whatsapp_ack(self):
+        self.assertEqual(parse_receipt({"id": "true_1@c.us", "ack": 2}), ["true_1@c.us", "Delivered"])
+        self.assertEqual(parse_receipt({"id": "true_1@c.us", "ack": 4}), ["true_1@c.us", "Read"])
+        self.assertEqual(parse_receipt({"id": "true_1@c.us", "ack": -1}), ["true_1@c.us", "Undelivered"])
+
+    def test_ignore_events_that_are_not_receipts(self):
+        # Sent / server acks, unknown statuses, booleans and events without an id
+        self.assertIsNone(parse_receipt({"id": "true_1@c.us", "ack": 1}))
+        self.assertIsNone(parse_receipt({"id": "true_1@c.us", "status": "queued"}))
+        self.assertIsNone(parse_receipt({"id": "true_1@c.us", "ack": True}))
+        self.assertIsNone(parse_receipt({"status": "delivered"}))
+        self.assertIsNone(parse_receipt("delivered"))
+
+    def test_event_shapes(self):
+        event = {"id": "1", "ack": 3}
+        self.assertEqual(get_events(event), [event])
+        self.assertEqual(get_events([event, event]), [event, event])
+        self.assertEqual(get_events({"data": [event]}), [event])
+        self.assertEqual(get_events(None), [])
@@ -0,0 +1,139 @@
+"""Hormuud access token cache.
+
+The token lives in process memory and in Redis. Lookups on the send path
+are a dict read; only when the token is about to expire does a worker go to
+Redis, and only one worker at a time (guarded by a Redis lock) asks Hormuud
+for a new one while the others keep using the old token or wait for it.
+"""
+
+import json
+import time
+from datetime import datetime
+
+import pytz
+
+import frappe
+from frappe import _
+from frappe.utils import cint, get_system_timezone
+
+from four_whats_net.clients import HormuudClient
+from four_whats_net.settings import get_settings
+from four_whats_net.utils import single_flight
+
+HORMUUD_SETTINGS = "Hormuud SMS Configuration"
+
+TOKEN_CACHE_KEY = "four_whats_net:hormuud_token"
+REFRESH_LOCK_KEY = "four_whats_net:hormuud_token_refresh"
+
+# Refresh this many seconds before the provider says the token expires
+REFRESH_AHEAD = 300
+REFRESH_LOCK_TIMEOUT = 30
+# Used when the token response carries no expiry at all
+DEFAULT_TOKEN_TTL = 3600
+
+EXPIRES_FORMAT = "%a, %d %b %Y %H:%M:%S %Z"
+
+# site -> {"access_token": ..., "expires_at": unix timestamp}
+_tokens = {}
+
+
+class TokenUnavailable(Exception):
+    """No Hormuud token could be had right now; the messages are worth retrying."""
+
+
+def get_hormuud_token():
+    """Return a valid Hormuud access token, refreshing it ahead of expiry."""
+    token = _tokens.get(frappe.local.site)
+    if is_fresh(token):
+        return token["access_token"]
+
+    token = read_shared_token()
+    if is_fresh(token):
+        _tokens[frappe.local.site] = token
+        return token["access_token"]
+
+    return refresh_token(stale=token)
+
+
+def invalidate_hormuud_token():
+    """Drop the cached token, e.g. after the provider rejected it."""
+    _tokens.pop(frappe.local.site, None)
+    cache = frappe.cache()
+    cache.delete(cache.make_key(TOKEN_CACHE_KEY))
+
+
+def is_fresh(token):
+    return bool(token) and time.time() < token["expires_at"] - REFRESH_AHEAD
+
+
+def is_valid(token):
+    return bool(token) and time.time() < token["expires_at"]
+
+
+def read_shared_token():
+    # Raw Redis read: frappe.cache().get_value() would serve a stale copy from
+    # frappe.local for the rest of a long-running job
+    cache = frappe.cache()
+    value = cache.get(cache.make_key(TOKEN_CACHE_KEY))
+    return json.loads(value) if value else None
+
+
+def refresh_token(stale=None):
+    """Single-flight refresh: one worker fetches, the rest reuse or wait."""
+
+    def produce():
+        # Someone may have refreshed between our read and taking the lock
+        token = read_shared_token()
+        return token if is_fresh(token) else fetch_token()
+
+    def wait_for():
+        # Another worker is refreshing; the old token is good until it really expires
+        if is_valid(stale):
+            return stale
+        token = read_shared_token()
+        return token if is_valid(token) else None
+
+    token = single_flight(
+        frappe.cache().make_key(REFRESH_LOCK_KEY),
+        REFRESH_LOCK_TIMEOUT,
+        produce,
+        wait_for,
+        TokenUnavailable(_("Timed out waiting for a Hormuud access token")),
+    )
+    _tokens[frappe.local.site] = token
+    return token["access_token"]
+
+
+def fetch_token():
+    settings = get_settings(HORMUUD_SETTINGS)
+    # A requests error propagates as is, so `is_retryable` can tell an outage from bad credentials
+    token_data = HormuudClient(settings).fetch_token(settings.username, settings.password, settings.grant_type)
+
+    if not token_data.get("access_token"):
+        frappe.throw(_("Hormuud did not return an access token"))
+
+    token = {"access_token": token_data["access_token"], "expires_at": get_expires_at(token_data)}
+    cache = frappe.cache()
+    cache.set(
+        cache.make_key(TOKEN_CACHE_KEY),
+        json.dumps(token),
+        ex=max(int(token["expires_at"] - time.time()), 1),
+    )
+
+    # Keep the configuration form informative; nothing reads these back on the send path
+    expiry_date = datetime.fromtimestamp(token["expires_at"], pytz.timezone(get_system_timezone()))
+    frappe.db.set_single_value(
+        HORMUUD_SETTINGS,
+        {"token": token["access_token"], "expiry_date": expiry_date.replace(tzinfo=None)},
+        update_modified=False,
+    )
+    return token
+
+
+def get_expires_at(token_data):
+    if token_data.get("expires_in"):
+        return time.time() + cint(token_data["expires_in"])
+    if token_data.get(".expires"):
+        expires = datetime.strptime(token_data[".expires"], EXPIRES_FORMAT).replace(tzinfo=pytz.UTC)
+        return expires.timestamp()
+    return time.time() + DEFAULT_TOKEN_TTL
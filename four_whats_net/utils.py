@@ -0,0 +1,112 @@
+import time
+
+import frappe
+from frappe.model.naming import parse_naming_series
+from frappe.utils import cint, now_datetime
+
+
+def bulk_insert(doctype, rows, ignore_duplicates=False):
+    """Insert plain dict rows into `doctype` with one multi-row INSERT.
+
+    Bypasses the document lifecycle (no validate/hooks), so only use it for
+    log-style doctypes the app owns. Names follow the doctype's autoname
+    (naming series or hash). Returns the names in row order.
+    """
+    if not rows:
+        return []
+
+    now = now_datetime()
+    user = frappe.session.user
+    fields = list(rows[0])
+    names = make_names(doctype, len(rows))
+    values = [
+        (name, now, now, user, user, 0, *(row.get(field) for field in fields))
+        for name, row in zip(names, rows)
+    ]
+    frappe.db.bulk_insert(
+        doctype,
+        ["name", "creation", "modified", "owner", "modified_by", "docstatus", *fields],
+        values,
+        ignore_duplicates=ignore_duplicates,
+    )
+    return names
+
+
+def make_names(doctype, count):
+    """Return `count` new names for `doctype`, reserving a naming-series block in one go."""
+    autoname = frappe.get_meta(doctype).autoname or ""
+    if ".#" not in autoname:
+        return [frappe.generate_hash(length=10) for _ in range(count)]
+
+    # "WMSG-.YYYY.-.#####" -> prefix "WMSG-2026-", 5 digits
+    series, hashes = autoname.rsplit(".", 1)
+    prefix = parse_naming_series(series)
+    digits = len(hashes)
+
+    current = frappe.db.sql("select `current` from `tabSeries` where `name`=%s for update", (prefix,))
+    if current and current[0][0] is not None:
+        start = cint(current[0][0])
+        frappe.db.sql("update `tabSeries` set `current` = `current` + %s where `name`=%s", (count, prefix))
+    else:
+        start = 0
+        frappe.db.sql("insert into `tabSeries` (`name`, `current`) values (%s, %s)", (prefix, count))
+
+    return [f"{prefix}{start + i:0{digits}d}" for i in range(1, count + 1)]
+
+
+def single_flight(lock_key, ttl, produce, wait_for, timeout_error, poll=0.05):
+    """Run `produce` in one worker at a time across the site; the others wait for its result.
+
+    Whoever holds the Redis lock at `lock_key` calls `produce`, which should
+    first check whether someone finished before it took the lock. The others
+    poll `wait_for` - a result usable instead, or None - and raise
+    `timeout_error` once `ttl` seconds pass without one.
+    """
+    cache = frappe.cache()
+    deadline = time.time() + ttl
+    while not cache.set(lock_key, frappe.local.site, nx=True, ex=ttl):
+        result = wait_for()
+        if result is not None:
+            return result
+        if time.time() > deadline:
+            raise timeout_error
+        time.sleep(poll)
+
+    try:
+        return produce()
+    finally:
+        cache.delete(lock_key)
+
+
+class RedisScript:
+    """A Lua script against the site's Redis, callable from any thread.
+
+    Build it on a thread with a frappe site context (the connection and the
+    site-scoped key names come from it), then `call` it from anywhere.
+    Lua numbers are truncated to integers on the way out, so scripts return
+    fractions as strings; `call` turns numeric strings back into floats.
+    """
+
+    def __init__(self, source):
+        self.script = frappe.cache().register_script(source)
+
+    def call(self, keys, args):
+        reply = self.script(keys=keys, args=args)
+        if isinstance(reply, list):
+            return [decode_reply(value) for value in reply]
+        return decode_reply(reply)
+
+
+def decode_reply(value):
+    if not isinstance(value, bytes):
+        return value
+    value = value.decode()
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def get_redis_key(name, shared=False):
+    """`name` scoped to the current site, or to the whole bench with `shared`."""
+    return frappe.cache().make_key(name, shared=shared)
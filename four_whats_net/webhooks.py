@@ -0,0 +1,271 @@
+"""Delivery and read receipts posted by 4Whats.net and Hormuud.
+
+The endpoints only check the shared secret, pick the message id and status
+out of each event and push them onto a Redis list - no database work - so
+a burst of receipts is acknowledged in milliseconds. `apply_receipts`
+drains the list in batches, keeps the most advanced status per message and
+writes each status with one UPDATE matched on the provider message id the
+send path stored in the message log. Numbers whose last BOUNCE_THRESHOLD
+messages all came back Undelivered go on the suppression list for that
+channel for BOUNCE_SUPPRESSION_DAYS.
+
+A receipt can beat its log row to the database (the send path buffers log
+rows, e.g. for a whole broadcast chunk). Receipts matching no row are set
+aside and tried again by the next few scheduler runs before being dropped.
+
+Point the providers at
+
+    /api/method/four_whats_net.webhooks.four_whats_receipts?token=<secret>
+    /api/method/four_whats_net.webhooks.hormuud_receipts?token=<secret>
+
+with the Webhook Secret from the provider's configuration.
+"""
+
+import hmac
+import json
+
+import frappe
+from frappe import _
+from frappe.utils import add_days, now_datetime, today
+
+from four_whats_net import metrics
+from four_whats_net.delivery import CHANNEL_SETTINGS
+from four_whats_net.message_log import LOG_DOCTYPES, LOG_FIELDS
+from four_whats_net.settings import get_settings
+from four_whats_net.suppression import add_suppression
+
+RECEIPT_QUEUE_KEY = "four_whats_net:receipts"
+
+# Wake a worker as soon as this many receipts are waiting; the scheduler
+# drains whatever is left every minute
+APPLY_THRESHOLD = 1000
+BATCH_SIZE = 5000
+LOCK_TTL = 5 * 60
+
+# Scheduler runs an unmatched receipt waits for its log row before it is dropped
+MAX_RECEIPT_ATTEMPTS = 10
+
+# Undelivered receipts in a row, with nothing delivered in between, before a
+# number is suppressed; a single one may be a phone that was switched off
+BOUNCE_THRESHOLD = 3
+# Days a bouncing number stays suppressed before it is tried again
+BOUNCE_SUPPRESSION_DAYS = 30
+
+# Later statuses win; a late "delivered" never overwrites "read"
+RECEIPT_RANK = {"Undelivered": 1, "Delivered": 2, "Read": 3}
+
+RECEIPT_STATUSES = {
+    "delivered": "Delivered",
+    "delivrd": "Delivered",
+    "delivery_ack": "Delivered",
+    "read": "Read",
+    "played": "Read",
+    "undelivered": "Undelivered",
+    "undeliv": "Undelivered",
+    "failed": "Undelivered",
+    "rejected": "Undelivered",
+    "expired": "Undelivered",
+}
+
+# WhatsApp "ack" levels: 2 = delivered to the phone, 3 = read, 4 = played, -1 = error
+ACK_STATUSES = {2: "Delivered", 3: "Read", 4: "Read", -1: "Undelivered"}
+
+MESSAGE_ID_KEYS = ("MessageID", "messageId", "message_id", "id")
+STATUS_KEYS = ("Status", "status", "event", "ack")
+
+
+@frappe.whitelist(allow_guest=True, methods=["POST"])
+def four_whats_receipts(token=None):
+    return receive("4Whats.net", token)
+
+
+@frappe.whitelist(allow_guest=True, methods=["POST"])
+def hormuud_receipts(token=None):
+    return receive("SMSHormuud", token)
+
+
+def receive(channel, token):
+    secret = get_settings(CHANNEL_SETTINGS[channel]).webhook_secret
+    if not secret or not token or not hmac.compare_digest(token.encode(), secret.encode()):
+        raise frappe.AuthenticationError(_("Invalid webhook token"))
+
+    try:
+        payload = json.loads(frappe.request.get_data() or "null")
+    except ValueError:
+        frappe.throw(_("Receipts must be JSON"))
+
+    receipts = [receipt for receipt in map(parse_receipt, get_events(payload)) if receipt]
+    if receipts:
+        queue_receipts(channel, receipts)
+    return {"accepted": len(receipts)}
+
+
+def get_events(payload):
+    """A provider posts one event, a list of them, or a list under "data"."""
+    if isinstance(payload, dict) and isinstance(payload.get("data"), list):
+        return payload["data"]
+    if isinstance(payload, list):
+        return payload
+    return [payload] if isinstance(payload, dict) else []
+
+
+def parse_receipt(event):
+    """Return [provider_message_id, receipt_status] for an event, or None if it is not a receipt."""
+    if not isinstance(event, dict):
+        return None
+
+    message_id = next((event[key] for key in MESSAGE_ID_KEYS if event.get(key)), None)
+    status = next((event[key] for key in STATUS_KEYS if event.get(key) is not None), None)
+    if isinstance(status, int) and not isinstance(status, bool):
+        status = ACK_STATUSES.get(status)
+    elif isinstance(status, str):
+        status = RECEIPT_STATUSES.get(status.strip().lower())
+    else:
+        status = None
+
+    if not message_id or not status:
+        return None
+    return [str(message_id), status]
+
+
+def queue_receipts(channel, receipts):
+    cache = frappe.cache()
+    queue_key = get_queue_key(channel)
+    pipeline = cache.pipeline()
+    pipeline.rpush(queue_key, *[json.dumps(receipt) for receipt in receipts])
+    pipeline.llen(queue_key)
+    _, waiting = pipeline.execute()
+
+    if waiting >= APPLY_THRESHOLD and cache.set(get_queue_key(channel, "scheduled"), 1, nx=True, ex=LOCK_TTL):
+        frappe.enqueue("four_whats_net.webhooks.apply_receipts", queue="short", channel=channel)
+
+
+def apply_receipts(channel=None, batch_size=BATCH_SIZE):
+    """Scheduler hook: write the buffered receipts to the message logs."""
+    cache = frappe.cache()
+    for log_channel in [channel] if channel else LOG_DOCTYPES:
+        cache.delete(get_queue_key(log_channel, "scheduled"))
+        lock_key = get_queue_key(log_channel, "lock")
+        if not cache.set(lock_key, 1, nx=True, ex=LOCK_TTL):
+            continue
+
+        try:
+            if not channel:
+                # Once a minute, not on every early wake-up, so the log rows get time to land
+                requeue_unmatched(log_channel)
+            while apply_batch(log_channel, batch_size):
+                cache.expire(lock_key, LOCK_TTL)
+        finally:
+            cache.delete(lock_key)
+            metrics.flush_metrics()
+
+
+def requeue_unmatched(channel):
+    """Put the receipts the last runs could not match back on the queue."""
+    unmatched_key = get_queue_key(channel, "unmatched")
+    pipeline = frappe.cache().pipeline()
+    pipeline.lrange(unmatched_key, 0, -1)
+    pipeline.delete(unmatched_key)
+    raw, _ = pipeline.execute()
+    if raw:
+        frappe.cache().pipeline().rpush(get_queue_key(channel), *raw).execute()
+
+
+def apply_batch(channel, batch_size):
+    """Apply up to `batch_size` receipts; returns how many were taken off the queue."""
+    cache = frappe.cache()
+    queue_key = get_queue_key(channel)
+    pipeline = cache.pipeline()
+    pipeline.lrange(queue_key, 0, batch_size - 1)
+    pipeline.ltrim(queue_key, batch_size, -1)
+    raw, _ = pipeline.execute()
+    if not raw:
+        return 0
+
+    # Keep only the most advanced status per message
+    latest = {}
+    attempts = {}
+    for item in raw:
+        message_id, status, *tried = json.loads(item)
+        if RECEIPT_RANK[status] > RECEIPT_RANK.get(latest.get(message_id), 0):
+            latest[message_id] = status
+        attempts[message_id] = max(attempts.get(message_id, 0), tried[0] if tried else 0)
+
+    by_status = {}
+    for message_id, status in latest.items():
+        by_status.setdefault(status, []).append(message_id)
+
+    doctype = LOG_DOCTYPES[channel]
+    now = now_datetime()
+    unmatched = []
+    try:
+        for status, message_ids in by_status.items():
+            lower = [other for other, rank in RECEIPT_RANK.items() if rank < RECEIPT_RANK[status]]
+            frappe.db.sql(
+                f"""update `tab{doctype}`
+                set receipt_status = %(status)s, receipt_at = %(now)s
+                where provider_message_id in %(message_ids)s
+                    and (receipt_status is null or receipt_status = '' or receipt_status in %(lower)s)""",
+                {"status": status, "now": now, "message_ids": tuple(message_ids), "lower": tuple(lower) or ("",)},
+            )
+        if by_status.get("Undelivered"):
+            suppress_bounced(channel, by_status["Undelivered"])
+        frappe.db.commit()
+
+        matched = set(
+            frappe.get_all(doctype, filters={"provider_message_id": ["in", list(latest)]}, pluck="provider_message_id")
+        )
+        unmatched = [message_id for message_id in latest if message_id not in matched]
+    except Exception:
+        frappe.db.rollback()
+        # Put them back for the next run rather than lose them (raw RPUSH: the
+        # RedisWrapper one takes one value and prefixes the key again)
+        cache.pipeline().rpush(queue_key, *raw).execute()
+        raise
+
+    retry = [
+        json.dumps([message_id, latest[message_id], attempts[message_id] + 1])
+        for message_id in unmatched
+        if attempts[message_id] + 1 < MAX_RECEIPT_ATTEMPTS
+    ]
+    if retry:
+        cache.pipeline().rpush(get_queue_key(channel, "unmatched"), *retry).execute()
+    metrics.count("four_whats_receipts_total", channel, "Applied", len(latest) - len(unmatched))
+    metrics.count("four_whats_receipts_total", channel, "Deferred", len(retry))
+    metrics.count("four_whats_receipts_total", channel, "Dropped", len(unmatched) - len(retry))
+
+    return len(raw)
+
+
+def suppress_bounced(channel, message_ids):
+    """Suppress the numbers of undelivered messages that keep bouncing, for a while."""
+    phone_field = LOG_FIELDS[channel]["phone_number"]
+    rows = frappe.get_all(
+        LOG_DOCTYPES[channel],
+        # Not those a later "delivered" or "read" has already overtaken
+        filters={"provider_message_id": ["in", message_ids], "receipt_status": "Undelivered"},
+        fields=[phone_field, "provider_message_id"],
+    )
+    bounced = {row.get(phone_field): row.provider_message_id for row in rows}
+    expires_on = add_days(today(), BOUNCE_SUPPRESSION_DAYS)
+    for phone_number, provider_message_id in bounced.items():
+        if is_bouncing(channel, phone_number):
+            add_suppression(
+                phone_number, channel, "Bounced", provider_message_id=provider_message_id, expires_on=expires_on
+            )
+
+
+def is_bouncing(channel, phone_number):
+    """Whether the receipts for the number's last BOUNCE_THRESHOLD messages all say Undelivered."""
+    statuses = frappe.get_all(
+        LOG_DOCTYPES[channel],
+        filters={LOG_FIELDS[channel]["phone_number"]: phone_number, "receipt_status": ["is", "set"]},
+        pluck="receipt_status",
+        order_by="creation desc",
+        limit=BOUNCE_THRESHOLD,
+    )
+    return len(statuses) == BOUNCE_THRESHOLD and all(status == "Undelivered" for status in statuses)
+
+
+def get_queue_key(channel, suffix=None):
+    return frappe.cache().make_key(f"{RECEIPT_QUEUE_KEY}:{channel}" + (f":{suffix}" if suffix else ""))